@@ -4,11 +4,27 @@ NAME="exeats"                                     # Name of the application
 DJANGODIR=/app/src/                               # Django project directory
 SOCKFILE=/run/gunicorn.sock                       # socket created outside of app dir to avoid
                                                   # Docker volume mounting issues
+PIDFILE=/run/gunicorn.pid                         # read by the deploy webhook to reload workers
 USER=root                                         # the user to run as
 GROUP=root                                        # the group to run as
-NUM_WORKERS=3                                     # how many worker processes should Gunicorn spawn
-DJANGO_SETTINGS_MODULE=exeatsproject.settings     # which settings file should Django use
+CPUS=$(nproc)
+NUM_WORKERS=${NUM_WORKERS:-$((CPUS * 2 + 1))}     # how many worker processes should Gunicorn spawn
+THREADS=${THREADS:-2}                             # threads per sync worker, to keep serving while
+                                                  # one waits on the database
+PROFILE=${PROFILE:-production}                    # development reloads on code changes and logs
+                                                  # at debug level
 DJANGO_WSGI_MODULE=exeatsproject.wsgi             # WSGI module name
+DJANGO_ASGI_MODULE=exeatsproject.asgi             # ASGI module name
+export INTERFACE=${INTERFACE:-wsgi}               # asgi serves the async signup views without
+                                                  # a worker waiting on each booking
+
+if [ "$PROFILE" = "development" ]; then
+  DJANGO_SETTINGS_MODULE=exeatsproject.settings
+  PROFILE_ARGS="--log-level=debug --reload"
+else
+  DJANGO_SETTINGS_MODULE=exeatsproject.settings_production
+  PROFILE_ARGS="--log-level=info"
+fi
 
 echo "Starting $NAME as `whoami`"
 
@@ -19,13 +35,23 @@ export PYTHONPATH=$DJANGODIR:$PYTHONPATH
 RUNDIR=$(dirname $SOCKFILE)
 test -d $RUNDIR || mkdir -p $RUNDIR
 
+if [ "$INTERFACE" = "asgi" ]; then
+  APPLICATION=${DJANGO_ASGI_MODULE}:application
+  WORKER_CLASS=uvicorn.workers.UvicornWorker
+else
+  APPLICATION=${DJANGO_WSGI_MODULE}:application
+  WORKER_CLASS=sync
+fi
+
 # Start your Django Unicorn
 # Programs meant to be run under supervisor should not daemonize themselves (do not use --daemon)
-exec gunicorn ${DJANGO_WSGI_MODULE}:application \
+exec gunicorn $APPLICATION \
   --name $NAME \
   --workers $NUM_WORKERS \
+  --worker-class $WORKER_CLASS \
+  --threads $THREADS \
   --user=$USER --group=$GROUP \
   --bind=unix:$SOCKFILE \
-  --log-level=debug \
+  --pid=$PIDFILE \
   --log-file=- \
-  --reload
+  $PROFILE_ARGS
@@ -0,0 +1,220 @@
+import heapq
+import random
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from .mail import queue_booking_confirmations
+from .models import Tutor, Slot, Preference
+from .slots import bookings_changed
+from .students import refresh_summaries
+from .tutors import tutor_changed
+
+MAX_PREFERENCES = 5
+
+
+def set_allocation_closes(tutor, closes):
+    """ starts allocating the tutor's slots by preference, closing at the aware datetime
+        `closes`, or goes back to first come first served if it is None """
+    with transaction.atomic():
+        tutor.allocation_closes = closes
+        tutor.save(update_fields=['allocation_closes'])
+        if closes is None:
+            Preference.objects.filter(student__tutor=tutor).delete()
+    tutor_changed(tutor.id)
+
+
+def is_allocating(tutor, now=None):
+    """ whether the tutor's students should be ranking slots rather than booking them """
+    return bool(tutor.allocation_closes) and tutor.allocation_closes > (now or timezone.now())
+
+
+def get_preferences(student):
+    """ returns {slot id: rank} of the student's preferences """
+    return dict(Preference.objects.filter(student=student).values_list('slot_id', 'rank'))
+
+
+def save_preferences(student, slot_ids):
+    """ replaces the student's preferences with the given slot ids, best first, leaving out any
+        which aren't free future slots of their tutor. Returns the number saved """
+    slot_ids = [int(slot_id) for slot_id in slot_ids][:MAX_PREFERENCES]
+    free = set(Slot.objects.filter(id__in=slot_ids, tutor=student.tutor_id, allocatedto=None,
+                                   start__gte=timezone.now())
+                           .values_list('id', flat=True))
+    preferences = [Preference(student=student, slot_id=slot_id, rank=rank)
+                   for rank, slot_id in enumerate((i for i in slot_ids if i in free), 1)]
+    with transaction.atomic():
+        Preference.objects.filter(student=student).delete()
+        Preference.objects.bulk_create(preferences)
+    return len(preferences)
+
+
+def get_due_tutor_ids(now=None):
+    return list(Tutor.objects.filter(allocation_closes__lte=now or timezone.now())
+                             .values_list('id', flat=True))
+
+
+def allocate_slots(tutor_id, seed=None):
+    """ gives the tutor's students the free slots they ranked, once their allocation has closed,
+        and goes back to first come first served for the slots left. Students who already hold
+        a future slot keep it. Everything is done in one transaction.
+        Returns {student id: slot id} of the slots given, or None if the tutor isn't due
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        tutor = Tutor.objects.select_for_update() \
+                             .filter(id=tutor_id, allocation_closes__lte=now).first()
+        if not tutor:
+            return None
+        # locked so that a booking from a page loaded before the allocation closed waits for
+        # it, and then finds the slot taken
+        free = set(Slot.objects.select_for_update()
+                               .filter(tutor=tutor, allocatedto=None, start__gte=now)
+                               .values_list('id', flat=True))
+        booked = set(Slot.objects.filter(tutor=tutor, allocatedto__isnull=False, start__gte=now)
+                                 .values_list('allocatedto_id', flat=True))
+        preferences = defaultdict(list)
+        for student_id, slot_id, rank in Preference.objects.filter(student__tutor=tutor) \
+                                                           .order_by('student', 'rank') \
+                                                           .values_list('student_id', 'slot_id',
+                                                                        'rank'):
+            if slot_id in free and student_id not in booked:
+                preferences[student_id].append((slot_id, rank))
+
+        # ties between equally good allocations are settled by chance rather than by who
+        # submitted their preferences first
+        student_ids = list(preferences)
+        random.Random(seed).shuffle(student_ids)
+        allocation = match([(student_id, preferences[student_id]) for student_id in student_ids])
+
+        Slot.objects.bulk_update([Slot(id=slot_id, allocatedto_id=student_id)
+                                  for student_id, slot_id in allocation.items()],
+                                 ['allocatedto'], batch_size=500)
+        Preference.objects.filter(student__tutor=tutor).delete()
+        tutor.allocation_closes = None
+        tutor.save(update_fields=['allocation_closes'])
+
+        slots = Slot.objects.filter(id__in=allocation.values()) \
+                            .select_related('tutor', 'allocatedto').order_by('start')
+        queue_booking_confirmations((slot.allocatedto, slot) for slot in slots)
+        bookings_changed(tutor_id, {slot_id: True for slot_id in allocation.values()})
+
+    tutor_changed(tutor_id)
+    refresh_summaries(list(allocation))
+    return allocation
+
+
+def match(preferences):
+    """ returns {student: slot} given a list of (student, [(slot, cost), ...]) of the slots each
+        student would accept. As many students as possible are given a slot, and of the ways of
+        doing that one with the lowest total cost is chosen: a min-cost bipartite matching.
+
+        Successive shortest paths, keeping a potential on every node so that the reduced costs
+        stay non-negative and Dijkstra can be used. Each round finds the cost of the cheapest
+        augmenting path, then augments along as many vertex-disjoint paths of that cost as a
+        depth first search of the zero reduced cost edges finds. Costs are small integers, so
+        there are few distinct path costs and so few rounds.
+    """
+    students = [student for student, _ in preferences]
+    slot_index = {}
+    edges = [[(slot_index.setdefault(slot, len(slot_index)), cost) for slot, cost in accepted]
+             for _, accepted in preferences]
+    slots = list(slot_index)
+    n, m = len(students), len(slots)
+
+    student_slot = [-1] * n  # index of the slot each student holds
+    student_cost = [0] * n  # and its cost
+    slot_student = [-1] * m
+    student_potential = [0] * n
+    slot_potential = [0] * m
+    sink_potential = 0
+    infinity = float('inf')
+
+    while True:
+        # Dijkstra from every unmatched student, over reduced costs, to the nearest free slot
+        student_dist = [infinity] * n
+        slot_dist = [infinity] * m
+        sink_dist = infinity
+        heap = []
+        for i in range(n):
+            if student_slot[i] == -1:
+                student_dist[i] = 0
+                heap.append((0, i))
+        heapq.heapify(heap)
+        while heap:
+            dist, node = heapq.heappop(heap)
+            if dist >= sink_dist:
+                break
+            if node < n:
+                if dist > student_dist[node]:
+                    continue
+                base = dist + student_potential[node]
+                for j, cost in edges[node]:
+                    if j != student_slot[node]:
+                        reduced = base + cost - slot_potential[j]
+                        if reduced < slot_dist[j]:
+                            slot_dist[j] = reduced
+                            heapq.heappush(heap, (reduced, n + j))
+            else:
+                j = node - n
+                if dist > slot_dist[j]:
+                    continue
+                holder = slot_student[j]
+                if holder == -1:
+                    sink_dist = min(sink_dist, dist + slot_potential[j] - sink_potential)
+                else:
+                    reduced = dist - student_cost[holder] + slot_potential[j] - \
+                        student_potential[holder]
+                    if reduced < student_dist[holder]:
+                        student_dist[holder] = reduced
+                        heapq.heappush(heap, (reduced, holder))
+        if sink_dist == infinity:
+            break
+
+        for i in range(n):
+            student_potential[i] += min(student_dist[i], sink_dist)
+        for j in range(m):
+            slot_potential[j] += min(slot_dist[j], sink_dist)
+        sink_potential += sink_dist
+
+        # augment along disjoint paths of edges whose reduced cost is now zero
+        visited = [False] * m
+        next_edge = [0] * n
+        for root in range(n):
+            if student_slot[root] != -1:
+                continue
+            path, chosen = [root], []
+            found = False
+            while path and not found:
+                i = path[-1]
+                advanced = False
+                while next_edge[i] < len(edges[i]):
+                    j, cost = edges[i][next_edge[i]]
+                    next_edge[i] += 1
+                    if visited[j] or j == student_slot[i] or \
+                       student_potential[i] + cost != slot_potential[j]:
+                        continue
+                    visited[j] = True
+                    holder = slot_student[j]
+                    if holder == -1:
+                        if slot_potential[j] == sink_potential:
+                            chosen.append((j, cost))
+                            found = True
+                            break
+                    else:
+                        chosen.append((j, cost))
+                        path.append(holder)
+                        advanced = True
+                        break
+                if not found and not advanced:
+                    path.pop()
+                    if chosen:
+                        chosen.pop()
+            if found:
+                for i, (j, cost) in zip(path, chosen):
+                    student_slot[i] = j
+                    student_cost[i] = cost
+                    slot_student[j] = i
+
+    return {students[i]: slots[student_slot[i]] for i in range(n) if student_slot[i] != -1}
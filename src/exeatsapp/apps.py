@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.core.signals import request_started
 
 
 class ExeatsappConfig(AppConfig):
     name = 'exeatsapp'
+
+    def ready(self):
+        from .db import check_connections
+        request_started.connect(check_connections)
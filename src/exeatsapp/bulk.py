@@ -0,0 +1,389 @@
+import bisect
+import datetime
+
+import pytz
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Tutor, Slot, Student
+from .slots import slots_changed, bookings_changed, get_suggestions, overlaps_existing
+from .students import normalise_email, is_valid_details, refresh_summaries
+
+# changes accepted in one request, across all of its lists
+MAX_ITEMS = 1000
+MAX_ID = 2 ** 31 - 1  # the largest an AutoField can hold
+
+
+class InvalidItem(Exception):
+    pass
+
+
+def apply_slot_changes(tutor_id, create=(), update=(), delete=()):
+    """ deletes, updates and then creates the tutor's slots in one transaction, with a constant
+        number of queries however many there are.
+        `create` is a list of {'start', 'location'}, `update` of {'id'} with any of 'start',
+        'location', 'attended' and 'student' (an id, or None to free the slot), and `delete`
+        a list of slot ids. As when adding slots on the times page, a slot can't overlap
+        another, taking them to last the tutor's usual duration. A student can only be given a
+        free slot, and as when booking, is freed from any other future slot they hold if it's
+        in the future.
+        Returns a dict of the result of each, in the same order
+    """
+    results = {'create': [], 'update': [], 'delete': []}
+    booking_changes = {}  # slot id: taken, for students' signup pages to catch up with
+    students = set()  # whose slot summaries need refreshing
+    listing_changed = attendance_changed = False
+
+    with transaction.atomic():
+        # locked, as create_slots() does, so concurrent changes can't both add overlapping slots
+        Tutor.objects.select_for_update().get(id=tutor_id)
+
+        delete_ids = parse_items(delete, parse_id, results['delete'])
+        found = dict(Slot.objects.filter(id__in=delete_ids.values(), tutor=tutor_id)
+                                 .values_list('id', 'allocatedto_id'))
+        Slot.objects.filter(id__in=found).delete()
+        for i, slot_id in delete_ids.items():
+            results['delete'][i] = ok(slot_id) if slot_id in found else not_found(slot_id)
+        students.update(found.values())
+        listing_changed = bool(found)
+
+        changes = parse_items(update, parse_slot_update, results['update'])
+        student_ids = {change['student'] for change in changes.values()
+                       if change.get('student') is not None}
+        # locked, and then the slots, in the order book_slot() locks them
+        known_students = set(Student.objects.select_for_update()
+                                            .filter(id__in=student_ids, tutor=tutor_id)
+                                            .values_list('id', flat=True))
+        slots = Slot.objects.select_for_update() \
+                            .in_bulk([change['id'] for change in changes.values()])
+        now = timezone.now()
+        booked = {}  # student id: the future slot they have been given
+        new_slots = parse_items(create, parse_slot, results['create'])
+        length = datetime.timedelta(minutes=get_suggestions(tutor_id)[1])
+        new_starts = [change['start'] for change in changes.values() if 'start' in change]
+        new_starts.extend(slot.start for slot in new_slots.values())
+        existing = get_nearby_starts(tutor_id, new_starts, length)
+        fields = set()
+        for i, change in changes.items():
+            slot = slots.get(change['id'])
+            if not slot or slot.tutor_id != tutor_id:
+                results['update'][i] = not_found(change['id'])
+                continue
+            if change.get('student') is not None and change['student'] != slot.allocatedto_id:
+                if change['student'] not in known_students:
+                    results['update'][i] = error(change['id'], 'no such student')
+                    continue
+                if slot.allocatedto_id is not None:
+                    results['update'][i] = error(change['id'], 'the slot is already booked')
+                    continue
+                if change['student'] in booked and change.get('start', slot.start) >= now:
+                    results['update'][i] = error(change['id'],
+                                                 'the student is given another slot')
+                    continue
+            if 'start' in change and change['start'] != slot.start:
+                remove_start(existing, slot.start)
+                if overlaps_existing(existing, change['start'], length):
+                    bisect.insort(existing, slot.start)
+                    results['update'][i] = error(change['id'], 'it would overlap another slot')
+                    continue
+                bisect.insort(existing, change['start'])
+                slot.start = change['start']
+                students.add(slot.allocatedto_id)
+                listing_changed = True
+                fields.add('start')
+            if 'location' in change:
+                slot.location = change['location']
+                listing_changed = True
+                fields.add('location')
+            if 'attended' in change:
+                slot.attended = change['attended']
+                students.add(slot.allocatedto_id)
+                attendance_changed = True
+                fields.add('attended')
+            if 'student' in change and change['student'] != slot.allocatedto_id:
+                students.update((slot.allocatedto_id, change['student']))
+                slot.allocatedto_id = change['student']
+                booking_changes[slot.id] = slot.allocatedto_id is not None
+                fields.add('allocatedto')
+                if slot.allocatedto_id is not None and slot.start >= now:
+                    booked[slot.allocatedto_id] = slot.id
+            results['update'][i] = ok(slot.id)
+        updated = [slots[change['id']] for i, change in changes.items()
+                   if results['update'][i]['ok']]
+
+        # free any other future slots held by the students given one
+        freed = [(slot_id, student_id) for slot_id, student_id in
+                 Slot.objects.select_for_update()
+                             .filter(allocatedto__in=booked, start__gte=now)
+                             .values_list('id', 'allocatedto_id')
+                 if slot_id != booked[student_id]]
+        Slot.objects.filter(id__in=[slot_id for slot_id, _ in freed]).update(allocatedto=None)
+        for slot_id, student_id in freed:
+            if slot_id in slots and slots[slot_id].allocatedto_id == student_id:
+                slots[slot_id].allocatedto_id = None  # so bulk_update doesn't book it again
+            booking_changes[slot_id] = False
+
+        if updated and fields:
+            Slot.objects.bulk_update(updated, fields, batch_size=500)
+
+        for i, slot in list(new_slots.items()):
+            if overlaps_existing(existing, slot.start, length):
+                results['create'][i] = error(None, 'it would overlap another slot')
+                del new_slots[i]
+            else:
+                bisect.insort(existing, slot.start)
+                slot.tutor_id = tutor_id
+        Slot.objects.bulk_create(new_slots.values())
+        if new_slots:
+            listing_changed = True
+            # bulk_create only sets the ids on postgresql, but each start is now unique
+            ids = dict(Slot.objects.filter(tutor=tutor_id,
+                                           start__in=[s.start for s in new_slots.values()])
+                                   .values_list('start', 'id'))
+            for i, slot in new_slots.items():
+                results['create'][i] = ok(slot.id or ids[slot.start])
+
+        if listing_changed:
+            slots_changed(tutor_id)
+        elif attendance_changed or booking_changes:
+            bookings_changed(tutor_id, booking_changes)
+
+    refresh_summaries([student_id for student_id in students if student_id])
+    return results
+
+
+def get_nearby_starts(tutor_id, starts, length):
+    """ returns the sorted starts of the tutor's slots which could overlap a slot of `length`
+        starting at any of `starts` """
+    if not starts:
+        return []
+    return list(Slot.objects.filter(tutor=tutor_id, start__gt=min(starts) - length,
+                                    start__lt=max(starts) + length)
+                            .order_by('start').values_list('start', flat=True))
+
+
+def remove_start(starts, start):
+    i = bisect.bisect_left(starts, start)
+    if i < len(starts) and starts[i] == start:
+        del starts[i]
+
+
+def mark_attendance(tutor_id, attendance):
+    """ sets whether each of the tutor's slots in the list of {'id', 'attended'} was attended,
+        in two queries. Returns the result of each, in the same order """
+    results = []
+    marks = parse_items(attendance, parse_attendance, results)
+    with transaction.atomic():
+        found = dict(Slot.objects.filter(id__in=[slot_id for slot_id, _ in marks.values()],
+                                         tutor=tutor_id)
+                                 .values_list('id', 'allocatedto_id'))
+        for attended in (True, False):
+            Slot.objects.filter(id__in=[slot_id for slot_id, value in marks.values()
+                                        if value == attended and slot_id in found]) \
+                        .update(attended=attended)
+        if found:
+            bookings_changed(tutor_id, {})
+    for i, (slot_id, _) in marks.items():
+        results[i] = ok(slot_id) if slot_id in found else not_found(slot_id)
+
+    refresh_summaries([student_id for student_id in found.values() if student_id])
+    return results
+
+
+def apply_student_changes(tutor_id, create=(), update=(), delete=()):
+    """ deletes, updates and then creates the tutor's students in one transaction, with a
+        constant number of queries however many there are.
+        `create` is a list of {'name', 'email'}, `update` of {'id'} with any of 'name', 'email'
+        and 'alert', and `delete` a list of student ids. Emails must be unique, as when
+        importing students. Returns a dict of the result of each, in the same order
+    """
+    results = {'create': [], 'update': [], 'delete': []}
+    with transaction.atomic():
+        delete_ids = parse_items(delete, parse_id, results['delete'])
+        found = set(Student.objects.filter(id__in=delete_ids.values(), tutor=tutor_id)
+                                   .values_list('id', flat=True))
+        Student.objects.filter(id__in=found).delete()  # which also frees any slots they had
+        for i, student_id in delete_ids.items():
+            results['delete'][i] = ok(student_id) if student_id in found else \
+                not_found(student_id)
+        changed = bool(found)
+
+        changes = parse_items(update, parse_student_update, results['update'])
+        created = parse_items(create, parse_student, results['create'])
+        students = Student.objects.filter(tutor=tutor_id) \
+                                  .in_bulk([change['id'] for change in changes.values()])
+        new_emails = [change['email'] for change in changes.values() if 'email' in change] + \
+                     [details['email'] for details in created.values()]
+        taken_emails = set(Student.objects.filter(email__in=new_emails)
+                                          .values_list('email', flat=True))
+        fields = set()
+        for i, change in changes.items():
+            student = students.get(change['id'])
+            if not student:
+                results['update'][i] = not_found(change['id'])
+                continue
+            if 'email' in change and change['email'] != student.email:
+                if change['email'] in taken_emails:
+                    results['update'][i] = error(student.id, 'email already added')
+                    continue
+                taken_emails.add(change['email'])
+                student.email = change['email']
+                fields.add('email')
+            for field in ('name', 'alert'):
+                if field in change:
+                    setattr(student, field, change[field])
+                    fields.add(field)
+            results['update'][i] = ok(student.id)
+        updated = [students[change['id']] for i, change in changes.items()
+                   if results['update'][i]['ok']]
+        if updated and fields:
+            Student.objects.bulk_update(updated, fields, batch_size=500)
+            changed = True
+
+        new_students = {}
+        for i, details in created.items():
+            if details['email'] in taken_emails:
+                results['create'][i] = error(None, 'email already added')
+            else:
+                taken_emails.add(details['email'])
+                new_students[i] = Student(tutor_id=tutor_id, **details)
+        Student.objects.bulk_create(new_students.values())
+        if new_students:
+            ids = dict(Student.objects.filter(tutor=tutor_id,
+                                              email__in=[s.email for s in new_students.values()])
+                                      .values_list('email', 'id'))
+            for i, student in new_students.items():
+                results['create'][i] = ok(student.id or ids[student.email])
+
+        if found:
+            bookings_changed(tutor_id)  # which frees any slots the students had
+        elif changed:
+            bookings_changed(tutor_id, {})  # the names shown against slots may have changed
+    return results
+
+
+def parse_items(items, parse, results):
+    """ returns {position: parsed item} of the items `parse` accepts, and sets `results` to a
+        list with the error for each item it doesn't """
+    parsed = {}
+    results[:] = [None] * len(items)
+    for i, item in enumerate(items):
+        try:
+            parsed[i] = parse(item)
+        except InvalidItem as e:
+            item_id = item.get('id') if isinstance(item, dict) else None
+            results[i] = error(item_id if isinstance(item_id, int) else None, str(e))
+    return parsed
+
+
+def parse_id(value):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise InvalidItem('id must be a number')
+    if not 0 < value <= MAX_ID:
+        raise InvalidItem('id out of range')
+    return value
+
+
+def parse_slot(item):
+    item = expect_dict(item, ('start', 'location'))
+    return Slot(start=parse_start(item['start']), location=parse_location(item['location']))
+
+
+def parse_slot_update(item):
+    item = expect_dict(item, ('id',))
+    change = {'id': parse_id(item['id'])}
+    if 'start' in item:
+        change['start'] = parse_start(item['start'])
+    if 'location' in item:
+        change['location'] = parse_location(item['location'])
+    if 'attended' in item:
+        change['attended'] = parse_bool(item['attended'], 'attended')
+    if 'student' in item:
+        change['student'] = None if item['student'] is None else parse_id(item['student'])
+    return change
+
+
+def parse_attendance(item):
+    item = expect_dict(item, ('id', 'attended'))
+    return parse_id(item['id']), parse_bool(item['attended'], 'attended')
+
+
+def parse_student(item):
+    item = expect_dict(item, ('name', 'email'))
+    details = {'name': parse_text(item['name'], 'name'),
+               'email': normalise_email(parse_text(item['email'], 'email'))}
+    if not is_valid_details(details['name'], details['email']):
+        raise InvalidItem('invalid name or email')
+    return details
+
+
+def parse_student_update(item):
+    item = expect_dict(item, ('id',))
+    change = {'id': parse_id(item['id'])}
+    for field in ('name', 'email'):
+        if field in item:
+            change[field] = parse_text(item[field], field)
+    if 'email' in change:
+        change['email'] = normalise_email(change['email'])
+    # stand in valid values for the fields being left as they are
+    if not is_valid_details(change.get('name', 'name'), change.get('email', 'email@')):
+        raise InvalidItem('invalid name or email')
+    if 'alert' in item:
+        change['alert'] = parse_bool(item['alert'], 'alert')
+    return change
+
+
+def expect_dict(item, required):
+    if not isinstance(item, dict):
+        raise InvalidItem('expected an object')
+    missing = [field for field in required if field not in item]
+    if missing:
+        raise InvalidItem('{} required'.format(', '.join(missing)))
+    return item
+
+
+def parse_start(value):
+    try:
+        start = parse_datetime(value) if isinstance(value, str) else None
+    except ValueError:
+        start = None
+    if start is None:
+        raise InvalidItem('start must be a date and time like 2018-06-06T09:30')
+    if timezone.is_naive(start):
+        try:
+            start = timezone.make_aware(start)
+        except pytz.InvalidTimeError:  # skipped or repeated as the clocks change
+            raise InvalidItem('start is not a single local time, give its UTC offset')
+    return start.astimezone(datetime.timezone.utc)
+
+
+def parse_location(value):
+    location = parse_text(value, 'location')
+    if len(location) > 100:
+        raise InvalidItem('location must be at most 100 characters')
+    return location
+
+
+def parse_text(value, field):
+    if not isinstance(value, str):
+        raise InvalidItem('{} must be a string'.format(field))
+    return value.strip()
+
+
+def parse_bool(value, field):
+    if not isinstance(value, bool):
+        raise InvalidItem('{} must be true or false'.format(field))
+    return value
+
+
+def ok(item_id):
+    return {'ok': True, 'id': item_id}
+
+
+def not_found(item_id):
+    return error(item_id, 'not found')
+
+
+def error(item_id, message):
+    return {'ok': False, 'id': item_id, 'error': message}
@@ -0,0 +1,22 @@
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+def check_connections(**kwargs):
+    """ closes persistent database connections which have stopped working, eg. after the
+        database or pooler restarted, so that the request opens a fresh one rather than failing.
+        Each connection is checked at most every DB_HEALTH_CHECK_SECONDS """
+    interval = settings.DB_HEALTH_CHECK_SECONDS
+    if interval is None:
+        return
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        now = time.monotonic()
+        if now - getattr(connection, 'health_checked', 0) < interval:
+            continue
+        connection.health_checked = now
+        if not connection.is_usable():
+            connection.close()
@@ -0,0 +1,132 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import traceback
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import Deploy
+
+logger = logging.getLogger(__name__)
+
+PHASE_TIMEOUT = 600  # seconds
+OUTPUT_KEPT = 4000  # characters of a failed phase's output stored on the deploy
+REQUIREMENTS = os.path.join(os.path.dirname(settings.BASE_DIR), 'requirements.txt')
+
+
+class DeployFailed(Exception):
+    pass
+
+
+def queue_deploy(commit=''):
+    """ records a deploy for the run_deploys worker to carry out """
+    return Deploy.objects.create(commit=commit[:40])
+
+
+def run_queued():
+    """ runs the most recently queued deploy, skipping any older ones as the latest code
+        includes their changes. Returns the deploy run, or None if none were queued """
+    with transaction.atomic():
+        deploy = Deploy.objects.select_for_update(skip_locked=True) \
+                               .filter(status=Deploy.QUEUED).order_by('-created').first()
+        if not deploy:
+            return None
+        Deploy.objects.filter(status=Deploy.QUEUED, created__lte=deploy.created) \
+                      .exclude(id=deploy.id).update(status=Deploy.SKIPPED)
+        deploy.status = Deploy.RUNNING
+        deploy.started = timezone.now()
+        deploy.save(update_fields=['status', 'started'])
+
+    try:
+        run_deploy(deploy)
+    except DeployFailed as e:
+        logger.error('Deploy %s failed: %s', deploy.id, e)
+        deploy.status = Deploy.FAILED
+        deploy.output = str(e)[-OUTPUT_KEPT:]
+    except Exception:
+        # recorded rather than raised, so the deploy isn't left running and the worker carries on
+        logger.exception('Deploy %s failed', deploy.id)
+        deploy.status = Deploy.FAILED
+        deploy.output = traceback.format_exc()[-OUTPUT_KEPT:]
+    else:
+        deploy.status = Deploy.SUCCEEDED
+    deploy.finished = timezone.now()
+    deploy.save(update_fields=['status', 'timings', 'output', 'finished'])
+    metrics.registry.flush()
+    return deploy
+
+
+def get_latest_deploy_id():
+    """ the id of the last successful deploy. Workers other than gunicorn's compare it with the
+        one they started with, and exit to be restarted by supervisor once the code has been
+        updated, so they never run old code against the newly migrated database for long """
+    return Deploy.objects.filter(status=Deploy.SUCCEEDED) \
+                         .order_by('-created').values_list('id', flat=True).first()
+
+
+def run_deploy(deploy):
+    """ updates the code and database then has gunicorn replace its workers, timing each phase.
+        The old workers keep serving until the new code has been checked to load, so
+        migrations must leave the database usable by the code currently deployed. The other
+        workers restart once the deploy has succeeded, see get_latest_deploy_id() """
+    python = sys.executable
+    previous = run_phase(deploy, 'revision', ['git', 'rev-parse', 'HEAD']).strip()
+    run_phase(deploy, 'fetch', ['git', 'pull', '--ff-only'])
+    if requirements_changed(previous):
+        run_phase(deploy, 'install', [python, '-m', 'pip', 'install', '-q', '-r', REQUIREMENTS])
+    run_phase(deploy, 'migrate', [python, 'manage.py', 'migrate', '--noinput'])
+    run_phase(deploy, 'collectstatic', [python, 'manage.py', 'collectstatic', '--noinput'])
+    # so the new workers needn't compile the modules they import
+    run_phase(deploy, 'compile', [python, '-m', 'compileall', '-q', settings.BASE_DIR])
+    # loads the new code in a fresh process, so code that can't start never reaches the workers
+    run_phase(deploy, 'check', [python, 'manage.py', 'warm_up'])
+
+    started = time.perf_counter()
+    reload_workers()
+    record_timing(deploy, 'reload', time.perf_counter() - started)
+
+
+def run_phase(deploy, phase, command):
+    """ runs a command from the project directory, returning its output """
+    started = time.perf_counter()
+    try:
+        result = subprocess.run(command, cwd=settings.BASE_DIR, timeout=PHASE_TIMEOUT,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+    except subprocess.TimeoutExpired:
+        raise DeployFailed('{} timed out after {}s'.format(phase, PHASE_TIMEOUT))
+    finally:
+        record_timing(deploy, phase, time.perf_counter() - started)
+    if result.returncode != 0:
+        raise DeployFailed('{} exited with {}:\n{}'.format(phase, result.returncode,
+                                                            result.stdout))
+    return result.stdout
+
+
+def record_timing(deploy, phase, duration):
+    deploy.timings[phase] = round(duration, 3)
+    metrics.observe('exeats_deploy_phase_seconds', duration, phase=phase)
+
+
+def requirements_changed(previous):
+    """ whether requirements.txt differs between the `previous` and current revisions """
+    return subprocess.run(['git', 'diff', '--quiet', previous, 'HEAD', '--', REQUIREMENTS],
+                          cwd=settings.BASE_DIR).returncode != 0
+
+
+def reload_workers():
+    """ asks gunicorn to gracefully replace its workers with ones running the updated code.
+        Workers warm up before accepting requests, see exeatsproject/wsgi.py, and the old ones
+        finish the requests they are serving before exiting """
+    if settings.GUNICORN_PIDFILE and os.path.exists(settings.GUNICORN_PIDFILE):
+        try:
+            with open(settings.GUNICORN_PIDFILE) as pidfile:
+                os.kill(int(pidfile.read()), signal.SIGHUP)
+        except (OSError, ValueError) as e:  # eg. a stale pidfile
+            raise DeployFailed('Could not reload gunicorn: {}'.format(e))
@@ -0,0 +1,118 @@
+import datetime
+import time
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Slot
+from .tutors import get_tutor
+
+# a tutor's upcoming slots are fetched once for each version of their slots, and shared by the
+# feeds of the tutor and of each of their students
+FEED_CACHE_KEY = 'calendar_feed_{}_{}'
+FEED_CACHE_SECONDS = 24 * 60 * 60
+
+# slots are shown ending when the next one starts, if it's within this long, else after
+# DEFAULT_SLOT_MINUTES
+MAX_SLOT_MINUTES = 60
+DEFAULT_SLOT_MINUTES = 10
+
+
+def get_feed_etag(tutor_id, version, student_id=None):
+    """ an etag for a feed of the tutor's slots, or the student's, which changes whenever the
+        slots do, and every day as past slots drop off, so it can be checked without fetching
+        any slots """
+    return '"{}-{}-{}-{}"'.format(tutor_id, student_id or 0, version,
+                                  timezone.localdate().toordinal())
+
+
+def get_feed(tutor_id, version):
+    """ returns (tutor name, events, last modified timestamp) for the tutor's upcoming slots,
+        where each event is a dict of the slot id, start, end, location and student id and
+        name. Built in one query and then cached until the slots' version changes, or the day
+        does """
+    key = FEED_CACHE_KEY.format(tutor_id, version)
+    feed = cache.get(key)
+    if feed is None or feed[3] != timezone.localdate():
+        feed = build_feed(tutor_id) + (timezone.localdate(),)
+        cache.set(key, feed, FEED_CACHE_SECONDS)
+    return feed[:3]
+
+
+def build_feed(tutor_id):
+    tutor = get_tutor(tutor_id)
+    midnight = timezone.make_aware(datetime.datetime.combine(timezone.localdate(),
+                                                             datetime.time.min))
+    slots = list(Slot.objects.filter(tutor=tutor_id, start__gte=midnight)
+                             .select_related('allocatedto')
+                             .only('start', 'location', 'allocatedto__name')
+                             .order_by('start'))
+    events = []
+    for i, slot in enumerate(slots):
+        end = slot.start + datetime.timedelta(minutes=DEFAULT_SLOT_MINUTES)
+        if i + 1 < len(slots) and slot.start < slots[i + 1].start <= \
+           slot.start + datetime.timedelta(minutes=MAX_SLOT_MINUTES):
+            end = slots[i + 1].start
+        events.append({
+            'id': slot.id,
+            'start': slot.start,
+            'end': end,
+            'location': slot.location,
+            'student_id': slot.allocatedto_id,
+            'student_name': slot.allocatedto.name if slot.allocatedto else None,
+        })
+    return tutor.name if tutor else '', events, int(time.time())
+
+
+def render_calendar(name, events, last_modified):
+    """ returns the events, which must each have a summary added, as an iCalendar (RFC 5545)
+        document """
+    domain = urlparse(settings.BASE_URL).hostname or 'exeats'
+    stamp = format_time(datetime.datetime.fromtimestamp(last_modified, datetime.timezone.utc))
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//{}//Exeats//EN'.format(domain),
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        'X-WR-CALNAME:' + escape(name),
+    ]
+    for event in events:
+        lines += [
+            'BEGIN:VEVENT',
+            'UID:slot-{}@{}'.format(event['id'], domain),
+            'DTSTAMP:' + stamp,
+            'DTSTART:' + format_time(event['start']),
+            'DTEND:' + format_time(event['end']),
+            'SUMMARY:' + escape(event['summary']),
+            'LOCATION:' + escape(event['location']),
+            'END:VEVENT',
+        ]
+    lines.append('END:VCALENDAR')
+    return ''.join(fold(line) + '\r\n' for line in lines)
+
+
+def format_time(value):
+    return value.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,') \
+               .replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def fold(line):
+    """ splits a content line into lines of at most 75 octets, as the RFC requires """
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+    parts, start = [], 0
+    while start < len(encoded):
+        end = min(start + (75 if not parts else 74), len(encoded))
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1  # don't split a multi-byte character
+        parts.append(encoded[start:end].decode('utf-8'))
+        start = end
+    return '\r\n '.join(parts)
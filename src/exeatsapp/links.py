@@ -0,0 +1,119 @@
+import base64
+import datetime
+import hashlib
+import hmac
+import re
+import time
+
+from django.conf import settings
+from django.urls import reverse
+from django.utils.http import base36_to_int, int_to_base36
+
+from .models import Student
+
+# links take the form <student id>.<tutor id>[.<expiry timestamp in base 36>].<signature>
+LINK_PATTERN = re.compile(r'(?P<payload>(?P<student_id>\d+)\.(?P<tutor_id>\d+)'
+                          r'(\.(?P<expires>[0-9a-z]{1,13}))?)\.(?P<signature>[\w-]{22})')
+LINK_SALT = 'exeatsapp.signup'
+
+# tutors' calendar feed links take the form <tutor id>.<signature>
+FEED_LINK_PATTERN = re.compile(r'(?P<tutor_id>\d+)\.(?P<signature>[\w-]{22})')
+
+# links sent before signing was introduced, <student id>-<md5 of salt and email>
+LEGACY_LINK_PATTERN = re.compile(r'(?P<student_id>\d+)-[0-9a-f]{12}')
+LEGACY_LINK_SALT = 'zov5!5!2onxl'
+
+
+def get_student_for_hash(hash):
+    """ returns the student (with their tutor) for a signup link hash, or None if the hash is
+        invalid or expired. Signed hashes are checked before the database is touched """
+    match = LINK_PATTERN.fullmatch(hash)
+    if match:
+        if not is_valid_signature(match):
+            return None
+        return Student.objects.select_related('tutor') \
+                              .filter(id=match.group('student_id'), tutor=match.group('tutor_id')) \
+                              .first()
+
+    match = LEGACY_LINK_PATTERN.fullmatch(hash)
+    if match and settings.SIGNUP_LINK_ACCEPT_LEGACY:
+        student = Student.objects.select_related('tutor') \
+                                 .filter(id=match.group('student_id')) \
+                                 .first()
+        if student and hmac.compare_digest(hash, get_legacy_hash_for_student(student)):
+            return student
+    return None
+
+
+def get_tutor_id_for_hash(hash):
+    """ returns the id of the tutor a signup link hash is for, without touching the database
+        for signed hashes, or None if the hash is invalid """
+    ids = get_ids_for_hash(hash)
+    return ids[1] if ids else None
+
+
+def get_ids_for_hash(hash):
+    """ returns the (student id, tutor id) a signup link hash is for, without touching the
+        database for signed hashes, or None if the hash is invalid """
+    match = LINK_PATTERN.fullmatch(hash)
+    if match:
+        if not is_valid_signature(match):
+            return None
+        return int(match.group('student_id')), int(match.group('tutor_id'))
+    student = get_student_for_hash(hash)
+    return (student.id, student.tutor_id) if student else None
+
+
+def is_valid_signature(match):
+    expires = match.group('expires')
+    if expires and base36_to_int(expires) < time.time():
+        return False
+    # any of the configured keys is accepted, so that links survive a key being rotated out
+    return any(hmac.compare_digest(match.group('signature'), sign(match.group('payload'), key))
+               for key in settings.SIGNUP_LINK_KEYS)
+
+
+def get_hash_for_student(student):
+    payload = '{}.{}'.format(student.id, student.tutor_id)
+    if settings.SIGNUP_LINK_MAX_AGE_DAYS:
+        max_age = datetime.timedelta(days=settings.SIGNUP_LINK_MAX_AGE_DAYS)
+        payload += '.' + int_to_base36(int(time.time() + max_age.total_seconds()))
+    return payload + '.' + sign(payload, settings.SIGNUP_LINK_KEYS[0])
+
+
+def get_feed_hash_for_tutor(tutor_id):
+    return '{}.{}'.format(tutor_id, sign('feed.{}'.format(tutor_id), settings.SIGNUP_LINK_KEYS[0]))
+
+
+def get_calendar_url_for_tutor(tutor_id):
+    hash = get_feed_hash_for_tutor(tutor_id)
+    return settings.BASE_URL + reverse('exeatsapp:tutor_calendar', kwargs={'hash': hash})
+
+
+def get_tutor_id_for_feed_hash(hash):
+    """ returns the id of the tutor a calendar feed link is for, or None if it is invalid """
+    match = FEED_LINK_PATTERN.fullmatch(hash)
+    if not match:
+        return None
+    payload = 'feed.{}'.format(match.group('tutor_id'))
+    if any(hmac.compare_digest(match.group('signature'), sign(payload, key))
+           for key in settings.SIGNUP_LINK_KEYS):
+        return int(match.group('tutor_id'))
+    return None
+
+
+def get_legacy_hash_for_student(student):
+    cleartext = LEGACY_LINK_SALT + student.email
+    return str(student.id) + '-' + hashlib.md5(cleartext.encode('utf-8')).hexdigest()[0:12]
+
+
+def get_url_for_student(student):
+    hash = get_hash_for_student(student)
+    return settings.BASE_URL + reverse('exeatsapp:signup', kwargs={'hash': hash})
+
+
+def sign(payload, key):
+    """ returns a url-safe HMAC-SHA256 signature of the payload, truncated to 128 bits """
+    digest = hmac.new((LINK_SALT + key).encode('utf-8'), payload.encode('utf-8'),
+                      hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
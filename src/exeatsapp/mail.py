@@ -0,0 +1,277 @@
+import datetime
+import json
+import logging
+import smtplib
+import time
+from email.mime.text import MIMEText
+from itertools import groupby
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Count, Min, Q
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from . import metrics
+from .links import get_url_for_student
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 60  # doubled after each failed attempt
+# emails are claimed by a worker for this long, plus the time the rate limit allows for
+# sending them, after which they are sent again if it hasn't recorded what happened
+CLAIM_SECONDS = 15 * 60
+
+RESULT_FIELDS = ['status', 'attempts', 'next_attempt', 'last_error', 'sent']
+
+# https://documentation.mailgun.com/en/latest/user_manual.html#batch-sending
+MAILGUN_MAX_RECIPIENTS = 1000
+MAILGUN_MAX_VARIABLES_BYTES = 64 * 1024
+
+
+def is_mailgun():
+    """ returns true if we are using mailgun as our smtp host """
+    return 'mailgun' in settings.EMAIL_HOST
+
+
+def get_from_email():
+    return '{}<{}>'.format(settings.SYSTEM_FROM_NAME, settings.SYSTEM_FROM_EMAIL)
+
+
+def email_policy_check(email):
+    """ overwrites email addresses with a saftey address if set """
+    return getattr(settings, 'ALL_EMAILS_TO', email)
+
+
+def get_recent_mailings(tutor_id, limit=5):
+    """ returns the tutor's latest mailings with counts of their queued, sent and failed emails """
+    return OutboundEmail.objects.filter(tutor=tutor_id) \
+                                .exclude(batch='') \
+                                .values('batch', 'subject') \
+                                .annotate(queued=Count('id', filter=Q(status=OutboundEmail.QUEUED)),
+                                          sent=Count('id', filter=Q(status=OutboundEmail.SENT)),
+                                          failed=Count('id', filter=Q(status=OutboundEmail.FAILED)),
+                                          created=Min('created')) \
+                                .order_by('-created')[:limit]
+
+
+def queue_booking_confirmation(student, slot):
+    """ queues an email confirming the student's booking of the slot """
+    email = get_booking_confirmation(student, slot)
+    email.save()
+    return email
+
+
+def queue_booking_confirmations(bookings):
+    """ queues emails confirming each of the (student, slot) bookings in one query """
+    return OutboundEmail.objects.bulk_create(get_booking_confirmation(student, slot)
+                                             for student, slot in bookings)
+
+
+def get_booking_confirmation(student, slot):
+    context = {'slot': slot, 'url': get_url_for_student(student)}
+    return OutboundEmail(tutor_id=student.tutor_id,
+                         to_email=email_policy_check(student.email),
+                         from_email=get_from_email(),
+                         subject='Booking confirmation',
+                         body=render_to_string('exeatsapp/emailconfirmation.html', context))
+
+
+class RateLimiter:
+    """ sleeps as needed so that wait() returns at most `per_minute` times a minute """
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute if per_minute else 0
+        self.next_allowed = 0
+
+    def wait(self, count=1):
+        pause = self.next_allowed - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        self.next_allowed = max(self.next_allowed, time.monotonic()) + self.interval * count
+
+
+def send_queued(limit=None, connection=None, rate_limiter=None):
+    """ sends up to `limit` due emails from the queue, reusing one SMTP connection.
+        The emails are claimed in a short transaction and sent outside it, and what happened
+        to each is saved as soon as it's known, so a worker stopped part way through only
+        sends again what it hadn't finished with.
+        Emails which fail with a temporary error are retried later with exponential backoff.
+        Returns a tuple of (sent_count, failed_count)
+    """
+    rate_limiter = rate_limiter or RateLimiter(settings.EMAIL_MAX_PER_MINUTE)
+    limit = limit or (MAILGUN_MAX_RECIPIENTS * 10 if is_mailgun() else 100)
+    with transaction.atomic():
+        # skip_locked lets several workers claim from the queue without sending anything twice
+        emails = list(OutboundEmail.objects.select_for_update(skip_locked=True)
+                                           .filter(status=OutboundEmail.QUEUED,
+                                                   next_attempt__lte=timezone.now())
+                                           .order_by('batch', 'next_attempt', 'id')[:limit])
+        claimed_until = timezone.now() + datetime.timedelta(
+            seconds=CLAIM_SECONDS + rate_limiter.interval * len(emails))
+        OutboundEmail.objects.filter(id__in=[email.id for email in emails]) \
+                             .update(next_attempt=claimed_until)
+    if not emails:
+        return 0, 0
+    for email in emails:
+        email.next_attempt = claimed_until
+
+    if is_mailgun():
+        send_mailgun_batches(emails, rate_limiter)
+    else:
+        send_individually(emails, connection or get_connection(), rate_limiter)
+
+    sent_count = sum(1 for email in emails if email.status == OutboundEmail.SENT)
+    failed_count = sum(1 for email in emails if email.status == OutboundEmail.FAILED)
+    return sent_count, failed_count
+
+
+def send_individually(emails, connection, rate_limiter):
+    try:
+        connection.open()
+    except (smtplib.SMTPException, OSError) as e:
+        logger.exception('Could not connect to SMTP server, emails left queued')
+        for email in emails:
+            mark_retry(email, e)
+        save_results(emails)
+        return
+
+    for i, email in enumerate(emails):
+        body = email.body.replace('[link]', email.link)
+        headers = {'Reply-To': email.reply_to} if email.reply_to else {}
+        message = EmailMessage(email.subject, body, email.from_email, [email.to_email],
+                               headers=headers, connection=connection)
+        rate_limiter.wait()
+        try:
+            with metrics.timed('exeats_smtp_send_seconds', method='individual'):
+                message.send()
+            mark_sent(email)
+        except smtplib.SMTPAuthenticationError as e:
+            # no point trying the rest until the credentials are fixed
+            logger.exception('SMTP login failed, emails left queued')
+            for unsent in emails[i:]:
+                mark_retry(unsent, e)
+            save_results(emails[i:])
+            break
+        except smtplib.SMTPServerDisconnected as e:
+            mark_retry(email, e)
+            connection.close()
+            try:
+                connection.open()
+            except (smtplib.SMTPException, OSError) as e:
+                for unsent in emails[i + 1:]:
+                    mark_retry(unsent, e)
+                save_results(emails[i:])
+                break
+        except (smtplib.SMTPException, OSError) as e:
+            mark_retry(email, e)
+        save_results([email])
+    connection.close()
+
+
+def send_mailgun_batches(emails, rate_limiter):
+    """ sends emails sharing a mailing and content as a few messages using mailgun's batch
+        sending feature, split into chunks within mailgun's limits and streamed over one SMTP
+        session. A failed chunk is left queued to be retried without affecting the others
+    """
+    attempted = set()
+    try:
+        smtp = open_mailgun_connection()
+        content = attrgetter('batch', 'subject', 'body', 'from_email', 'reply_to')
+        for _, group in groupby(emails, key=content):
+            for chunk in chunk_mailgun_recipients(list(group)):
+                rate_limiter.wait()
+                attempted.update(email.pk for email in chunk)
+                try:
+                    with metrics.timed('exeats_smtp_send_seconds', method='mailgun_batch'):
+                        refused = smtp.sendmail(settings.SYSTEM_FROM_EMAIL,
+                                                [email.to_email for email in chunk],
+                                                build_mailgun_message(chunk).as_string())
+                except smtplib.SMTPServerDisconnected as e:
+                    refused = {email.to_email: e for email in chunk}
+                    smtp = open_mailgun_connection()
+                except (smtplib.SMTPDataError, smtplib.SMTPRecipientsRefused) as e:
+                    refused = {email.to_email: e for email in chunk}
+                for email in chunk:
+                    if email.to_email in refused:
+                        mark_retry(email, refused[email.to_email])
+                    else:
+                        mark_sent(email)
+                save_results(chunk)
+                logger.info('Mailgun chunk of %d recipients sent, %d refused',
+                            len(chunk), len(refused))
+        smtp.quit()
+    except (smtplib.SMTPException, OSError) as e:
+        logger.exception('Mailgun batch sending failed, emails left queued')
+        unsent = [email for email in emails if email.pk not in attempted]
+        for email in unsent:
+            mark_retry(email, e)
+        save_results(unsent)
+
+
+def open_mailgun_connection():
+    smtp = smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT)
+    if settings.EMAIL_USE_TLS:
+        smtp.starttls()
+    smtp.login(settings.EMAIL_HOST_USER, settings.EMAIL_HOST_PASSWORD)
+    return smtp
+
+
+def chunk_mailgun_recipients(group):
+    """ yields lists of emails small enough for one mailgun batch message, limited both by
+        recipient count and by the size of the recipient variables header """
+    chunk, chunk_bytes = [], 0
+    for email in group:
+        email_bytes = len(json.dumps({email.to_email: {'link': email.link}}))
+        too_many = len(chunk) >= MAILGUN_MAX_RECIPIENTS
+        too_big = chunk_bytes + email_bytes > MAILGUN_MAX_VARIABLES_BYTES
+        if chunk and (too_many or too_big):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(email)
+        chunk_bytes += email_bytes
+    if chunk:
+        yield chunk
+
+
+def build_mailgun_message(group):
+    # to use mailgun's batch sending feature we need to pass a separate To: header on
+    # the message from that we give in the RCPT handshake, so we need to use a lower-
+    # level smtplib class.
+    # https://documentation.mailgun.com/en/latest/user_manual.html#batch-sending
+    first          = group[0]
+    msg            = MIMEText(first.body.replace('[link]', '%recipient.link%'))
+    msg['Subject'] = first.subject
+    msg['From']    = first.from_email
+    msg['To']      = "%recipient%"
+    if first.reply_to:
+        msg['Reply-To'] = first.reply_to
+    recipient_vars = {email.to_email: {'link': email.link} for email in group}
+    # the default json separators leave spaces at which the long header can be folded into
+    # lines within the 998 character limit, so don't compact them
+    msg['X-Mailgun-Recipient-Variables'] = json.dumps(recipient_vars)
+    return msg
+
+
+def save_results(emails):
+    OutboundEmail.objects.bulk_update(emails, RESULT_FIELDS)
+
+
+def mark_sent(email):
+    email.status = OutboundEmail.SENT
+    email.sent = timezone.now()
+    email.attempts += 1
+    email.last_error = ''
+
+
+def mark_retry(email, error):
+    email.attempts += 1
+    email.last_error = str(error)[:200]
+    if email.attempts >= MAX_ATTEMPTS:
+        email.status = OutboundEmail.FAILED
+    else:
+        delay = RETRY_BASE_SECONDS * 2 ** (email.attempts - 1)
+        email.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
@@ -0,0 +1,35 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from exeatsapp import metrics
+from exeatsapp.allocation import allocate_slots, get_due_tutor_ids
+from exeatsapp.deploys import get_latest_deploy_id
+
+
+class Command(BaseCommand):
+    help = 'Shares out the slots of tutors allocating by preference whose choices have closed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='keep running, checking for allocations which have closed. '
+                                 'Exits after a deploy, to be restarted running the new code')
+        parser.add_argument('--interval', type=float, default=30,
+                            help='seconds to wait between checks')
+
+    def handle(self, *args, **options):
+        deploy_id = get_latest_deploy_id()
+        while True:
+            for tutor_id in get_due_tutor_ids():
+                with metrics.timed('exeats_allocation_seconds'):
+                    allocation = allocate_slots(tutor_id)
+                if allocation is not None:
+                    metrics.registry.flush()
+                    self.stdout.write('Tutor {}: {} slots allocated'.format(tutor_id,
+                                                                            len(allocation)))
+            if not options['loop']:
+                break
+            if get_latest_deploy_id() != deploy_id:
+                sys.exit(0)
+            time.sleep(options['interval'])
@@ -0,0 +1,119 @@
+import datetime
+import random
+import statistics
+import time
+from collections import Counter
+from itertools import accumulate
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from exeatsapp.allocation import MAX_PREFERENCES, allocate_slots, match
+from exeatsapp.models import Tutor, Slot, Student, Preference
+
+
+class Command(BaseCommand):
+    help = 'Times allocating slots by preference to generated cohorts, and compares the ranks ' \
+           'students are given with first come first served booking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, nargs='+', default=[500, 2000, 5000],
+                            help='cohort sizes to time')
+        parser.add_argument('--slots-per-student', type=float, default=1.2)
+        parser.add_argument('--preferences', type=int, default=MAX_PREFERENCES,
+                            help='slots each student ranks')
+        parser.add_argument('--random-seed', type=int, default=None)
+        parser.add_argument('--tutor', type=int, default=None,
+                            help='instead time the whole allocation for this tutor, eg. of a '
+                                 'college from generate_college, with every student ranking '
+                                 'their free slots. It is rolled back afterwards')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['random_seed'])
+        if options['tutor']:
+            self.time_tutor(options['tutor'], options['preferences'], rng)
+            return
+
+        for student_count in options['students']:
+            slot_count = max(1, round(student_count * options['slots_per_student']))
+            preferences = generate_preferences(student_count, slot_count,
+                                               options['preferences'], rng)
+            started = time.perf_counter()
+            allocation = match(preferences)
+            duration = time.perf_counter() - started
+            self.stdout.write('{} students, {} slots: matched in {:.2f}s'.format(
+                              student_count, slot_count, duration))
+            self.stdout.write('  matching     ' + describe(preferences, allocation))
+            self.stdout.write('  first come   ' + describe(preferences,
+                                                           first_come(preferences, rng)))
+
+    def time_tutor(self, tutor_id, preference_count, rng):
+        tutor = Tutor.objects.filter(id=tutor_id).first()
+        if not tutor:
+            raise CommandError('No tutor {}'.format(tutor_id))
+        now = timezone.now()
+        slot_ids = list(Slot.objects.filter(tutor=tutor, allocatedto=None, start__gte=now)
+                                    .order_by('start').values_list('id', flat=True))
+        booked = Slot.objects.filter(tutor=tutor, start__gte=now, allocatedto__isnull=False) \
+                             .values_list('allocatedto_id', flat=True)
+        student_ids = list(Student.objects.filter(tutor=tutor).exclude(id__in=booked)
+                                          .values_list('id', flat=True))
+        if not slot_ids or not student_ids:
+            raise CommandError('The tutor has no free slots or no students without one')
+
+        with transaction.atomic():
+            preferences = generate_preferences(len(student_ids), len(slot_ids),
+                                               preference_count, rng)
+            Preference.objects.bulk_create(
+                (Preference(student_id=student_ids[student], slot_id=slot_ids[slot], rank=rank)
+                 for student, ranked in preferences for slot, rank in ranked), batch_size=1000)
+            Tutor.objects.filter(id=tutor.id).update(
+                allocation_closes=now - datetime.timedelta(seconds=1))
+
+            started = time.perf_counter()
+            allocation = allocate_slots(tutor.id, rng.random())
+            duration = time.perf_counter() - started
+            transaction.set_rollback(True)
+
+        self.stdout.write('{} students, {} slots: allocated in {:.2f}s, {} given a slot'.format(
+                          len(student_ids), len(slot_ids), duration, len(allocation)))
+
+
+def generate_preferences(student_count, slot_count, preference_count, rng):
+    """ returns (student, [(slot, rank), ...]) for students ranking slots, numbered from 0.
+        Some slots, eg. in the afternoon, are far more popular than others """
+    popularity = list(accumulate(rng.paretovariate(1.2) for _ in range(slot_count)))
+    preference_count = min(preference_count, slot_count)
+    preferences = []
+    for student in range(student_count):
+        ranked = []
+        while len(ranked) < preference_count:
+            slot = rng.choices(range(slot_count), cum_weights=popularity)[0]
+            if slot not in ranked:
+                ranked.append(slot)
+        preferences.append((student, [(slot, rank) for rank, slot in enumerate(ranked, 1)]))
+    return preferences
+
+
+def first_come(preferences, rng):
+    """ the slots students would get booking the best one left, in a random order """
+    order = list(preferences)
+    rng.shuffle(order)
+    taken, allocation = set(), {}
+    for student, ranked in order:
+        for slot, _ in ranked:
+            if slot not in taken:
+                taken.add(slot)
+                allocation[student] = slot
+                break
+    return allocation
+
+
+def describe(preferences, allocation):
+    ranks = {student: dict(ranked) for student, ranked in preferences}
+    given = [ranks[student][slot] for student, slot in allocation.items()]
+    counts = Counter(given)
+    return '{} of {} given a slot, mean rank {:.2f}, ranks {}'.format(
+        len(given), len(preferences), statistics.mean(given) if given else 0,
+        ' '.join('{}:{}'.format(rank, counts[rank]) for rank in sorted(counts)))
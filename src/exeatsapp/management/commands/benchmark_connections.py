@@ -0,0 +1,72 @@
+import statistics
+import time
+from wsgiref.util import setup_testing_defaults
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from exeatsapp.links import get_hash_for_student
+from exeatsapp.models import Student
+
+from .benchmark_views import percentile
+
+
+class Command(BaseCommand):
+    help = 'Times opening a database connection, and a student\'s signup page served with a ' \
+           'new connection for each request and then with a persistent one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--conn-max-age', type=int, default=600,
+                            help='CONN_MAX_AGE to compare against closing after each request')
+
+    def handle(self, *args, **options):
+        student = Student.objects.order_by('?').first()
+        if not student:
+            raise CommandError('No data to benchmark, use generate_college to create some')
+        path = reverse('exeatsapp:signup', kwargs={'hash': get_hash_for_student(student)})
+
+        connects = []
+        for _ in range(options['requests']):
+            connection.close()
+            started = time.perf_counter()
+            connection.ensure_connection()
+            connects.append(time.perf_counter() - started)
+        self.stdout.write('connect   p50 {:7.2f}ms  p95 {:7.2f}ms'.format(
+                          percentile(sorted(connects), 50) * 1000,
+                          percentile(sorted(connects), 95) * 1000))
+
+        # requests go through the real WSGI handler, as the test client never closes connections
+        handler = WSGIHandler()
+        original_max_age = connection.settings_dict['CONN_MAX_AGE']
+        try:
+            for max_age in (0, options['conn_max_age']):
+                connection.close()
+                connection.settings_dict['CONN_MAX_AGE'] = max_age
+                durations = self.time_requests(handler, path, options['requests'])
+                self.stdout.write('CONN_MAX_AGE={:<4} p50 {:7.2f}ms  p95 {:7.2f}ms  '
+                                  'mean {:7.2f}ms'.format(
+                                      max_age, percentile(durations, 50) * 1000,
+                                      percentile(durations, 95) * 1000,
+                                      statistics.mean(durations) * 1000))
+        finally:
+            connection.settings_dict['CONN_MAX_AGE'] = original_max_age
+
+    def time_requests(self, handler, path, count):
+        durations = []
+        with override_settings(ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ['127.0.0.1']):
+            for _ in range(count):
+                environ = {'PATH_INFO': path}
+                setup_testing_defaults(environ)
+                started = time.perf_counter()
+                response = handler(environ, lambda status, headers: None)
+                b''.join(response)
+                response.close()  # ends the request, closing the connection if it has expired
+                durations.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    raise CommandError('{} returned {}'.format(path, response.status_code))
+        return sorted(durations)
@@ -0,0 +1,142 @@
+import datetime
+import io
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from exeatsapp.models import Tutor, Slot, Student
+from exeatsapp.students import import_students, parse_student_details
+
+
+class Command(BaseCommand):
+    help = 'Prints query plans and timings for the hot slot and student queries, and ' \
+           'optionally of student imports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0,
+                            help='first insert this many synthetic slots, eg. 1000000')
+        parser.add_argument('--force', action='store_true',
+                            help='allow --seed when DEBUG is off')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='number of times to run each query when timing')
+        parser.add_argument('--import-rows', type=int, default=0,
+                            help='also time importing this many students, eg. 10000')
+        parser.add_argument('--parse-megabytes', type=int, default=0,
+                            help='also time parsing a CamSIS export of this size, eg. 20')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            if not settings.DEBUG and not options['force']:
+                raise CommandError('DEBUG is off, so this may be a live database. Use --force '
+                                   'to add synthetic slots to it anyway')
+            seed(options['seed'])
+            self.stdout.write('Seeded {} slots'.format(options['seed']))
+        if options['parse_megabytes']:
+            self.benchmark_parser(options['parse_megabytes'])
+
+        tutor = Tutor.objects.order_by('?').first()
+        student = Student.objects.filter(tutor=tutor).order_by('?').first()
+        if not tutor or not student:
+            self.stderr.write('No data to benchmark, use --seed to create some')
+            return
+        now = timezone.now()
+
+        queries = [
+            ('times/view: tutor slots from today',
+             Slot.objects.filter(tutor=tutor, start__gte=now).order_by('start')),
+            ('history: tutor past allocated slots',
+             Slot.objects.filter(tutor=tutor, start__lte=now, allocatedto__isnull=False)
+                         .order_by('-start')),
+            ('signup: student future booking',
+             Slot.objects.filter(allocatedto=student, start__gte=now)),
+            ('signup: free future slots',
+             Slot.objects.filter(tutor=tutor, allocatedto__isnull=True, start__gte=now)
+                         .order_by('start')),
+            ('update_students: student by email',
+             Student.objects.filter(email=student.email)),
+            ('students/emails: tutor students by name',
+             Student.objects.filter(tutor=tutor).order_by('name')),
+        ]
+
+        for label, queryset in queries:
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                list(queryset.all())
+            elapsed_ms = (time.perf_counter() - started) * 1000 / options['repeat']
+            self.stdout.write('\n{} ({:.2f}ms)'.format(label, elapsed_ms))
+            self.stdout.write(queryset.explain())
+
+        if options['import_rows']:
+            self.benchmark_import(tutor, options['import_rows'])
+
+    def benchmark_parser(self, megabytes):
+        header = '360\tLast Name\tFirst Name - Pref/Prim\tCRSID\tCollege\n'
+        line = '360{:07d}\tSmith\t"Alice"\tas{:d}\tExample College\n'
+        rows = [header]
+        size = len(header)
+        while size < megabytes * 1024 * 1024:
+            rows.append(line.format(len(rows), len(rows)))
+            size += len(rows[-1])
+        upload = io.BytesIO(''.join(rows).encode('utf-8'))
+
+        started = time.perf_counter()
+        count = sum(1 for _ in parse_student_details(upload))
+        elapsed = time.perf_counter() - started
+        self.stdout.write('\nparsed {} students from {}MB in {:.2f}s ({:.1f}MB/s)'.format(
+                          count, megabytes, elapsed, megabytes / elapsed))
+
+    def benchmark_import(self, tutor, row_count):
+        """ times a student import of `row_count` lines, half of them already known, rolling
+            back afterwards """
+        known = list(Student.objects.values_list('email', flat=True)[:row_count // 2])
+        lines = ['Student {}, {}'.format(i, email) for i, email in enumerate(known)]
+        lines += ['New Student {}, new{}'.format(i, i) for i in range(row_count - len(lines))]
+        with transaction.atomic():
+            started = time.perf_counter()
+            report = import_students(tutor.id, parse_student_details('\n'.join(lines)))
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            transaction.set_rollback(True)
+        self.stdout.write('\nimport of {} students: {} added, {} skipped ({:.0f}ms)'.format(
+                          row_count, len(report.added), len(report.skipped), elapsed_ms))
+
+
+def seed(slot_count, tutor_count=100, students_per_tutor=100, batch_size=5000):
+    """ bulk inserts `slot_count` slots spread over a few years either side of today, with
+        around two thirds of past slots booked """
+    with transaction.atomic():
+        suffix = int(time.time())
+        tutors = Tutor.objects.bulk_create([
+            Tutor(name='Tutor {}'.format(i), password='', isadmin=False,
+                  email='tutor{}.{}@example.com'.format(i, suffix))
+            for i in range(tutor_count)])
+        if not tutors[0].pk:  # backends which don't return ids from bulk inserts
+            tutors = list(Tutor.objects.filter(email__endswith='.{}@example.com'.format(suffix)))
+
+        Student.objects.bulk_create([
+            Student(name='Student {}'.format(i), tutor=tutor,
+                    email='student{}.{}.{}@example.com'.format(i, tutor.id, suffix))
+            for tutor in tutors for i in range(students_per_tutor)])
+        student_ids = {}
+        for student_id, tutor_id in Student.objects.filter(tutor__in=tutors) \
+                                                   .values_list('id', 'tutor'):
+            student_ids.setdefault(tutor_id, []).append(student_id)
+
+        now = timezone.now()
+        span_minutes = 3 * 365 * 24 * 60
+        slots = []
+        for i in range(slot_count):
+            tutor = tutors[i % len(tutors)]
+            minutes = random.randint(-span_minutes, span_minutes // 4)
+            start = now + datetime.timedelta(minutes=minutes)
+            booked = start < now and random.random() < 0.66
+            student_id = random.choice(student_ids[tutor.id]) if booked else None
+            slots.append(Slot(start=start, location='Room {}'.format(tutor.id), tutor=tutor,
+                              allocatedto_id=student_id, attended=booked and random.random() < 0.8))
+            if len(slots) == batch_size:
+                Slot.objects.bulk_create(slots)
+                slots = []
+        Slot.objects.bulk_create(slots)
@@ -0,0 +1,248 @@
+import datetime
+import json
+import random
+import re
+import statistics
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from exeatsapp.links import get_hash_for_student
+from exeatsapp.models import Tutor, Slot, Student
+
+
+class Command(BaseCommand):
+    help = 'Times the main pages for one tutor, eg. of a college from generate_college, and ' \
+           'writes their latency percentiles and query counts to a JSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50,
+                            help='number of times to request each page')
+        parser.add_argument('--tutor', type=int, default=None,
+                            help='id of the tutor to benchmark, by default the one with the '
+                                 'most students')
+        parser.add_argument('--output', default='benchmark.json',
+                            help='file to write the results to')
+        parser.add_argument('--compare', default=None,
+                            help='results of an earlier run to print the changes against')
+        parser.add_argument('--url', default=None,
+                            help='request pages from a running server at this base url, eg. '
+                                 'http://localhost:8000, rather than through the test client. '
+                                 'Query counts are not available this way')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='number of simultaneous requests when using --url')
+        parser.add_argument('--book', type=int, default=0,
+                            help='with --url, also time this many of the tutor\'s students '
+                                 'booking slots at once, as after a mailing. The bookings are '
+                                 'kept, so only use this against a generated college')
+        parser.add_argument('--include-writes', action='store_true',
+                            help='also time booking slots, each booking being rolled back. '
+                                 'Only with the test client')
+
+    def handle(self, *args, **options):
+        if options['tutor']:
+            tutor = Tutor.objects.filter(id=options['tutor']).first()
+        else:
+            tutor = Tutor.objects.annotate(students=Count('student')) \
+                                 .order_by('-students').first()
+        student = Student.objects.filter(tutor=tutor).order_by('?').first()
+        if not tutor or not student:
+            raise CommandError('No data to benchmark, use generate_college to create some')
+
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session['tutor_id'] = tutor.id
+        session['tutor_email'] = tutor.email
+        session.save()
+        signup_url = reverse('exeatsapp:signup', kwargs={'hash': get_hash_for_student(student)})
+        pages = [
+            ('signup', signup_url),
+            ('times', reverse('exeatsapp:times')),
+            ('emails', reverse('exeatsapp:emails')),
+            ('view', reverse('exeatsapp:view')),
+            ('history', reverse('exeatsapp:history')),
+        ]
+
+        results = {}
+        if options['url']:
+            for name, url in pages:
+                results[name] = self.time_http(options['url'] + url, session.session_key,
+                                               options['requests'], options['concurrency'])
+            if options['book']:
+                results['signup_book'] = self.time_http_bookings(options['url'], tutor,
+                                                                 options['book'],
+                                                                 options['concurrency'])
+        else:
+            client = Client()
+            client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+            with override_settings(ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ['testserver']):
+                for name, url in pages:
+                    results[name] = self.time_client(lambda: client.get(url),
+                                                     options['requests'])
+                if options['include_writes']:
+                    results['signup_book'] = self.time_booking(client, student, signup_url,
+                                                               options['requests'])
+
+        report = {
+            'created': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'mode': options['url'] or 'test client',
+            'concurrency': options['concurrency'] if options['url'] else 1,
+            'tutor': tutor.id,
+            'students': Student.objects.filter(tutor=tutor).count(),
+            'slots': Slot.objects.filter(tutor=tutor).count(),
+            'pages': results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as compare:
+                previous = json.load(compare)['pages']
+        for name, result in results.items():
+            self.stdout.write(format_result(name, result, (previous or {}).get(name)))
+        self.stdout.write('Results written to {}'.format(options['output']))
+
+    def time_client(self, request, count, status=200):
+        """ times `request` `count` times, failing unless each response has the `status`, so
+            that eg. a redirect to the login page isn't timed instead of the page """
+        durations, query_counts = [], []
+        for _ in range(count):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = request()
+                durations.append(time.perf_counter() - started)
+            if response.status_code != status:
+                raise CommandError('{} returned {}'.format(response.request['PATH_INFO'],
+                                                           response.status_code))
+            query_counts.append(len(queries))
+        return summarise(durations, query_counts)
+
+    def time_booking(self, client, student, signup_url, count):
+        """ times booking the free slots nearest now, rolling each booking back """
+        slots = list(Slot.objects.filter(tutor=student.tutor_id, allocatedto__isnull=True,
+                                         start__gte=timezone.now() + datetime.timedelta(hours=1))
+                                 .order_by('start')[:count])
+        if not slots:
+            raise CommandError('The tutor has no free slots to book')
+
+        def book(slot):
+            with transaction.atomic():
+                response = client.post(signup_url, {'slot_{}'.format(slot.id): 'Book'},
+                                       HTTP_REFERER=signup_url)
+                transaction.set_rollback(True)
+            return response
+        slots = (slots * count)[:count]
+        return self.time_client(lambda: book(slots.pop()), count, status=302)
+
+    def time_http(self, url, session_key, count, concurrency):
+        opener = urllib.request.build_opener(NoRedirectHandler())
+
+        def fetch(_):
+            request = urllib.request.Request(url, headers={
+                'Cookie': '{}={}'.format(settings.SESSION_COOKIE_NAME, session_key)})
+            started = time.perf_counter()
+            try:
+                with opener.open(request) as response:
+                    response.read()
+            except urllib.error.HTTPError as e:
+                raise CommandError('{} returned {}'.format(url, e.code))
+            if response.status != 200:
+                raise CommandError('{} returned {}'.format(url, response.status))
+            return time.perf_counter() - started
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            durations = list(executor.map(fetch, range(count)))
+        return summarise(durations, None)
+
+    def time_http_bookings(self, base_url, tutor, count, concurrency):
+        """ times students each loading their signup page and booking one of the free slots,
+            `concurrency` at a time, so that some of them compete for the same slot """
+        students = list(Student.objects.filter(tutor=tutor).order_by('?')[:count])
+        slot_ids = list(Slot.objects.filter(tutor=tutor, allocatedto__isnull=True,
+                                            start__gte=timezone.now() + datetime.timedelta(hours=1))
+                                    .order_by('start').values_list('id', flat=True)[:count * 2])
+        if not slot_ids:
+            raise CommandError('The tutor has no free slots to book')
+
+        def book(student):
+            url = base_url + reverse('exeatsapp:signup',
+                                     kwargs={'hash': get_hash_for_student(student)})
+            opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(),
+                                                 NoRedirectHandler())
+            with opener.open(url) as response:
+                token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"',
+                                  response.read().decode()).group(1)
+            data = urllib.parse.urlencode({'csrfmiddlewaretoken': token,
+                                           'slot_{}'.format(random.choice(slot_ids)): 'Book'})
+            request = urllib.request.Request(url, data.encode(), headers={'Referer': url})
+            started = time.perf_counter()
+            try:
+                opener.open(request).close()
+            except urllib.error.HTTPError as e:
+                if e.code != 302:
+                    raise
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            durations = list(executor.map(book, students))
+        result = summarise(durations, None)
+        result['bookings_per_second'] = len(students) / (time.perf_counter() - started)
+        result['booked'] = Slot.objects.filter(id__in=slot_ids, allocatedto__in=students).count()
+        return result
+
+
+class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """ leaves redirects unfollowed, so that only the booking is timed, and a page which
+        redirects, eg. to the login page, fails rather than timing the page it redirects to """
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def summarise(durations, query_counts):
+    durations = sorted(durations)
+    result = {
+        'requests': len(durations),
+        'mean_ms': statistics.mean(durations) * 1000,
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p95_ms': percentile(durations, 95) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+        'max_ms': durations[-1] * 1000,
+    }
+    if query_counts:
+        result['queries_median'] = statistics.median(query_counts)
+        result['queries_max'] = max(query_counts)
+    return result
+
+
+def percentile(ordered, percent):
+    """ nearest-rank percentile of an ordered list """
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def format_result(name, result, previous=None):
+    line = '{:<12} p50 {:8.1f}ms  p95 {:8.1f}ms  p99 {:8.1f}ms'.format(
+        name, result['p50_ms'], result['p95_ms'], result['p99_ms'])
+    if 'queries_median' in result:
+        line += '  {:g} queries'.format(result['queries_median'])
+    if 'bookings_per_second' in result:
+        line += '  {:.1f} bookings/s, {} booked'.format(result['bookings_per_second'],
+                                                         result['booked'])
+    if previous:
+        line += '  (p50 {:+.0%}, p95 {:+.0%})'.format(
+            result['p50_ms'] / previous['p50_ms'] - 1, result['p95_ms'] / previous['p95_ms'] - 1)
+    return line
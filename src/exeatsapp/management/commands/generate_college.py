@@ -0,0 +1,164 @@
+import datetime
+import random
+import time
+from itertools import accumulate
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from exeatsapp.models import Tutor, Slot, Student
+from exeatsapp.slots import slots_changed
+from exeatsapp.students import refresh_summaries
+
+INSERT_CHUNK = 10000  # slots held in memory before being bulk inserted
+SLOT_MINUTES = (10, 15, 20)
+SESSION_STARTS = (datetime.time(9), datetime.time(9, 30), datetime.time(13))
+# so that even the latest, slowest session ends by midnight rather than running into the next
+MAX_SESSION_SLOTS = (24 * 60 - SESSION_STARTS[-1].hour * 60) // max(SLOT_MINUTES)
+
+# chances of a slot being booked, and of a booked slot being attended
+PAST_BOOKED = 0.7
+NEXT_WEEK_BOOKED = 0.5
+LATER_BOOKED = 0.15
+ATTENDED = 0.88
+
+# Cambridge full terms, roughly, as (first, last) day of the year
+TERMS = ((7, 80), (114, 170), (278, 340))
+TERM_WEIGHT = 4  # sessions are this much more likely on a day in term
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with a synthetic college of tutors, students and their ' \
+           'booked and attended slots, for benchmarking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tutors', type=int, default=40)
+        parser.add_argument('--students', type=int, default=20000,
+                            help='total number of students, shared unevenly between tutors')
+        parser.add_argument('--slots', type=int, default=1000000,
+                            help='total number of slots, eg. 5000000')
+        parser.add_argument('--years', type=float, default=3,
+                            help='how far back the slots go')
+        parser.add_argument('--weeks-ahead', type=int, default=4,
+                            help='how far ahead tutors have added slots')
+        parser.add_argument('--random-seed', type=int, default=None,
+                            help='seed for a repeatable college')
+        parser.add_argument('--force', action='store_true',
+                            help='allow generating a college when DEBUG is off')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError('DEBUG is off, so this may be a live database. Use --force to '
+                               'add a synthetic college to it anyway')
+        rng = random.Random(options['random_seed'])
+        started = time.perf_counter()
+        suffix = '{}.{}'.format(int(time.time()), rng.randrange(1000))
+        tutor_count = options['tutors']
+
+        # a few tutors have far more students than others
+        weights = [rng.lognormvariate(0, 0.5) for _ in range(tutor_count)]
+        student_counts = [max(1, round(options['students'] * w / sum(weights))) for w in weights]
+
+        days = get_session_days(options['years'], options['weeks_ahead'])
+        total_slots = 0
+        for i, student_count in enumerate(student_counts):
+            with transaction.atomic():
+                tutor = Tutor.objects.create(name='Tutor {}'.format(i), password='',
+                                             isadmin=False,
+                                             email='tutor{}.{}@example.com'.format(i, suffix))
+                student_ids = create_students(tutor, student_count, suffix)
+                slot_count = options['slots'] * (i + 1) // tutor_count - \
+                    options['slots'] * i // tutor_count
+                total_slots += create_slots(tutor, student_ids, days, slot_count, rng)
+                refresh_summaries_in_batches(student_ids)
+            slots_changed(tutor.id)
+            self.stdout.write('Tutor {} of {}: {} students'.format(i + 1, tutor_count,
+                                                                   student_count))
+
+        self.stdout.write('Generated {} tutors, {} students and {} slots in {:.0f}s'.format(
+                          tutor_count, sum(student_counts), total_slots,
+                          time.perf_counter() - started))
+        if total_slots < options['slots']:
+            self.stdout.write('Only {} slots fit in one session a weekday, use more --tutors '
+                              'or --years for more'.format(total_slots))
+
+
+def get_session_days(years, weeks_ahead):
+    """ returns (date, weight) for each weekday tutors might hold a session on """
+    today = timezone.localdate()
+    first = today - datetime.timedelta(days=round(years * 365))
+    last = today + datetime.timedelta(weeks=weeks_ahead)
+    days = []
+    for offset in range((last - first).days + 1):
+        day = first + datetime.timedelta(days=offset)
+        if day.weekday() < 5:
+            day_of_year = day.timetuple().tm_yday
+            in_term = any(start <= day_of_year <= end for start, end in TERMS)
+            days.append((day, TERM_WEIGHT if in_term else 1))
+    return days
+
+
+def create_students(tutor, count, suffix):
+    Student.objects.bulk_create(
+        Student(name='Student {} {}'.format(tutor.id, i), tutor=tutor,
+                email='student{}.{}.{}@example.com'.format(i, tutor.id, suffix))
+        for i in range(count))
+    return list(Student.objects.filter(tutor=tutor).values_list('id', flat=True))
+
+
+def create_slots(tutor, student_ids, days, slot_count, rng):
+    """ bulk inserts `slot_count` slots for the tutor in sessions of consecutive slots,
+        one session a day on days chosen mostly in term, or as many as fit in a session on
+        every day. Returns the number inserted """
+    slot_count = min(slot_count, len(days) * MAX_SESSION_SLOTS)
+    session_count = min(len(days), max(1, slot_count // 12))
+    chosen = sorted(weighted_sample(days, session_count, rng))
+
+    # some students book far more often than others
+    popularity = list(accumulate(rng.paretovariate(1.5) for _ in student_ids))
+    now = timezone.now()
+    future_booked = set()  # students may only have one upcoming booking
+    slots, inserted = [], 0
+    location = 'Staircase {}, Room {}'.format(rng.choice('ABCDEFGH'), rng.randint(1, 20))
+    for i, day in enumerate(chosen):
+        minutes = rng.choice(SLOT_MINUTES)
+        start = timezone.make_aware(datetime.datetime.combine(day, rng.choice(SESSION_STARTS)))
+        # the slots are shared out evenly between the sessions
+        session_slots = slot_count * (i + 1) // session_count - slot_count * i // session_count
+        for _ in range(session_slots):
+            student_id, attended = None, False
+            if start < now:
+                if rng.random() < PAST_BOOKED:
+                    student_id = rng.choices(student_ids, cum_weights=popularity)[0]
+                    attended = rng.random() < ATTENDED
+            else:
+                chance = NEXT_WEEK_BOOKED if start - now < datetime.timedelta(weeks=1) \
+                    else LATER_BOOKED
+                if rng.random() < chance and len(future_booked) < len(student_ids):
+                    student_id = rng.choice(student_ids)
+                    while student_id in future_booked:
+                        student_id = rng.choice(student_ids)
+                    future_booked.add(student_id)
+            slots.append(Slot(start=start, location=location, tutor=tutor,
+                              allocatedto_id=student_id, attended=attended))
+            start += datetime.timedelta(minutes=minutes)
+            if len(slots) == INSERT_CHUNK:
+                Slot.objects.bulk_create(slots)
+                inserted += len(slots)
+                slots = []
+    Slot.objects.bulk_create(slots)
+    return inserted + len(slots)
+
+
+def weighted_sample(population, count, rng):
+    """ returns `count` distinct items from (item, weight) pairs, favouring heavier ones """
+    # https://en.wikipedia.org/wiki/Reservoir_sampling#Algorithm_A-Res
+    keyed = ((rng.random() ** (1 / weight), item) for item, weight in population)
+    return [item for _, item in sorted(keyed, reverse=True)[:count]]
+
+
+def refresh_summaries_in_batches(student_ids, batch_size=1000):
+    for i in range(0, len(student_ids), batch_size):
+        refresh_summaries(student_ids[i:i + batch_size])
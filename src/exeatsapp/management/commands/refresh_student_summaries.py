@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from exeatsapp.models import Student
+from exeatsapp.students import refresh_summaries
+
+
+class Command(BaseCommand):
+    help = 'Recalculates the slot summary of every student, e.g. after migrating'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of students to update in each query')
+
+    def handle(self, *args, **options):
+        student_ids = list(Student.objects.order_by('id').values_list('id', flat=True))
+        for i in range(0, len(student_ids), options['batch_size']):
+            refresh_summaries(student_ids[i:i + options['batch_size']])
+        self.stdout.write('{} students refreshed'.format(len(student_ids)))
@@ -0,0 +1,33 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from exeatsapp.deploys import run_queued
+from exeatsapp.models import Deploy
+
+
+class Command(BaseCommand):
+    help = 'Carries out deploys queued by the deploy webhook'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='keep running, polling for new deploys. Exits after a '
+                                 'successful deploy, to be restarted running the new code')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='seconds to wait between polls')
+
+    def handle(self, *args, **options):
+        while True:
+            deploy = run_queued()
+            if deploy:
+                self.stdout.write('Deploy {} {}: {}'.format(
+                    deploy.id, deploy.status,
+                    ', '.join('{} {:.1f}s'.format(phase, seconds)
+                              for phase, seconds in deploy.timings.items())))
+                if deploy.status == Deploy.SUCCEEDED and options['loop']:
+                    sys.exit(0)
+            if not options['loop']:
+                break
+            if not deploy:
+                time.sleep(options['interval'])
@@ -0,0 +1,40 @@
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from exeatsapp import metrics
+from exeatsapp.deploys import get_latest_deploy_id
+from exeatsapp.mail import send_queued, RateLimiter
+
+
+class Command(BaseCommand):
+    help = 'Sends emails waiting in the outbound queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='keep running, polling the queue for new emails. Exits '
+                                 'after a deploy, to be restarted running the new code')
+        parser.add_argument('--interval', type=float, default=2,
+                            help='seconds to wait between polls of an empty queue')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='maximum emails to send over each SMTP connection, by default '
+                                 '100 or 10000 when using mailgun batches')
+
+    def handle(self, *args, **options):
+        # shared across batches so the rate limit holds however the queue is split
+        rate_limiter = RateLimiter(settings.EMAIL_MAX_PER_MINUTE)
+        deploy_id = get_latest_deploy_id()
+        while True:
+            sent_count, failed_count = send_queued(options['batch_size'],
+                                                   rate_limiter=rate_limiter)
+            if sent_count or failed_count:
+                metrics.registry.flush()  # so the send times are reported while we're idle
+                self.stdout.write('{} sent, {} failed'.format(sent_count, failed_count))
+            if not options['loop']:
+                break
+            if get_latest_deploy_id() != deploy_id:
+                sys.exit(0)
+            if not sent_count and not failed_count:
+                time.sleep(options['interval'])
@@ -0,0 +1,16 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from exeatsapp.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = 'Loads the views, url resolver and templates as a new web worker does, failing if ' \
+           'any of them can\'t be loaded'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        count = warm_up()
+        self.stdout.write('Loaded {} templates in {:.2f}s'.format(
+                          count, time.perf_counter() - started))
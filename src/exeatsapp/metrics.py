@@ -0,0 +1,249 @@
+import asyncio
+import bisect
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# each process shares its metrics through the cache this often, so that the endpoint can
+# report the totals across all gunicorn workers and the email sender
+FLUSH_SECONDS = 10
+WORKER_TIMEOUT = 60 * 60  # a worker's metrics are forgotten this long after its last flush
+WORKERS_KEY = 'metrics_workers'
+
+SLOW_REQUEST_TOP_QUERIES = 5
+
+DESCRIPTIONS = {
+    'exeats_request_duration_seconds': 'Time taken to respond to requests',
+    'exeats_responses_total': 'Responses by status code',
+    'exeats_requests_sampled_total': 'Requests profiled for queries and template rendering',
+    'exeats_db_queries_total': 'Database queries made by profiled requests',
+    'exeats_db_query_seconds_total': 'Time spent in database queries by profiled requests',
+    'exeats_template_render_seconds_total': 'Time spent rendering templates by profiled requests',
+    'exeats_smtp_send_seconds': 'Time taken to hand emails to the SMTP server',
+    'exeats_deploy_phase_seconds': 'Time taken by each phase of deploys',
+    'exeats_allocation_seconds': 'Time taken to allocate a tutor\'s slots by preference',
+}
+
+
+class Registry:
+    """ the counters and histograms recorded by this process """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.last_flush = time.monotonic()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[name, tuple(sorted(labels.items()))] += value
+        self.maybe_flush()
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = name, tuple(sorted(labels.items()))
+            # a count per bucket, then the sum and count of all observations
+            histogram = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 1) + [0.0, 0])
+            histogram[bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush > FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        with self.lock:
+            snapshot = dict(self.counters), {k: list(v) for k, v in self.histograms.items()}
+        worker = os.getpid()
+        cache.set('metrics_worker_{}'.format(worker), snapshot, WORKER_TIMEOUT)
+        workers = cache.get(WORKERS_KEY, {})
+        if worker not in workers or workers[worker] < time.time() - FLUSH_SECONDS * 6:
+            workers = {w: t for w, t in workers.items() if t > time.time() - WORKER_TIMEOUT}
+            workers[worker] = time.time()
+            cache.set(WORKERS_KEY, workers, None)
+
+
+registry = Registry()
+local = threading.local()
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+@contextmanager
+def timed(name, **labels):
+    """ records how long the block takes in the named histogram """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def collect():
+    """ returns the (counters, histograms) of every process which has flushed recently """
+    registry.flush()
+    counters, histograms = defaultdict(float), {}
+    workers = cache.get(WORKERS_KEY, {})
+    snapshots = cache.get_many(['metrics_worker_{}'.format(w) for w in workers])
+    for worker_counters, worker_histograms in snapshots.values():
+        for key, value in worker_counters.items():
+            counters[key] += value
+        for key, values in worker_histograms.items():
+            totals = histograms.setdefault(key, [0] * len(values))
+            histograms[key] = [total + value for total, value in zip(totals, values)]
+    return counters, histograms
+
+
+def render_prometheus(counters, histograms):
+    """ returns the metrics in the prometheus text exposition format """
+    def format_labels(labels, **extra):
+        labels = labels + tuple(extra.items())
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                                       .replace('"', '\\"'))
+                              for k, v in labels) + '}'
+
+    lines = []
+    for name in sorted({name for name, _ in histograms}):
+        lines.append('# HELP {} {}'.format(name, DESCRIPTIONS.get(name, name)))
+        lines.append('# TYPE {} histogram'.format(name))
+        for (_, labels), values in sorted(i for i in histograms.items() if i[0][0] == name):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), values):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, le=bound),
+                                                     cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), values[-2]))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), values[-1]))
+    for name in sorted({name for name, _ in counters}):
+        lines.append('# HELP {} {}'.format(name, DESCRIPTIONS.get(name, name)))
+        lines.append('# TYPE {} counter'.format(name))
+        for (_, labels), value in sorted(i for i in counters.items() if i[0][0] == name):
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """ times every request by view, and for a sample of them (METRICS_SAMPLE_RATE) also
+        records the database queries made and the time spent rendering templates.
+        Requests slower than METRICS_SLOW_REQUEST_SECONDS are logged with their slowest queries.
+        Under ASGI, requests are only timed as their queries run in other threads
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # marks the instance as a coroutine function, as django's own middleware does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        local.profile = None
+        if random.random() < settings.METRICS_SAMPLE_RATE:
+            local.profile = {'queries': [], 'template_seconds': 0.0}
+            with connection.execute_wrapper(record_query):
+                response = self.get_response(request)
+        else:
+            response = self.get_response(request)
+        profile, local.profile = local.profile, None
+        record_request(request, response, time.perf_counter() - start, profile)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        record_request(request, response, time.perf_counter() - start, None)
+        return response
+
+
+def record_request(request, response, duration, profile):
+    match = getattr(request, 'resolver_match', None)
+    view = match.view_name if match else 'unresolved'
+    observe('exeats_request_duration_seconds', duration, view=view)
+    inc('exeats_responses_total', view=view, status=response.status_code)
+    if profile is not None:
+        inc('exeats_requests_sampled_total', view=view)
+        inc('exeats_db_queries_total', len(profile['queries']), view=view)
+        inc('exeats_db_query_seconds_total', sum(d for d, _ in profile['queries']), view=view)
+        inc('exeats_template_render_seconds_total', profile['template_seconds'], view=view)
+
+    if duration > settings.METRICS_SLOW_REQUEST_SECONDS:
+        log_slow_request(request, view, duration, profile)
+
+
+def record_query(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if local.profile is not None:
+            local.profile['queries'].append((time.perf_counter() - start, sql))
+
+
+def log_slow_request(request, view, duration, profile):
+    if profile is None:
+        logger.warning('Slow request %s %s (%s) took %.3fs, not profiled',
+                       request.method, request.path, view, duration)
+        return
+    queries = profile['queries']
+    slowest = sorted(queries, key=lambda query: query[0], reverse=True)
+    logger.warning('Slow request %s %s (%s) took %.3fs: %d queries in %.3fs, '
+                   'templates %.3fs. Slowest queries:\n%s',
+                   request.method, request.path, view, duration,
+                   len(queries), sum(d for d, _ in queries), profile['template_seconds'],
+                   '\n'.join('  {:.3f}s {}'.format(d, sql[:500])
+                             for d, sql in slowest[:SLOW_REQUEST_TOP_QUERIES]))
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """ the django template backend, timing the rendering of templates in profiled requests """
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        profile = getattr(local, 'profile', None)
+        if profile is None:
+            return self.template.render(context, request)
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            profile['template_seconds'] += time.perf_counter() - start
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exeatsapp', '0003_student_alert'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='slot',
+            index=models.Index(fields=['tutor', 'start'], name='slot_tutor_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='slot',
+            index=models.Index(fields=['allocatedto', 'start'], name='slot_allocatedto_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='slot',
+            index=models.Index(condition=models.Q(allocatedto__isnull=True), fields=['tutor', 'start'], name='slot_free_tutor_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['email'], name='student_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['tutor', 'name'], name='student_tutor_name_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exeatsapp', '0004_slot_student_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch', models.CharField(blank=True, max_length=32)),
+                ('to_email', models.CharField(max_length=100)),
+                ('from_email', models.CharField(max_length=200)),
+                ('reply_to', models.CharField(blank=True, max_length=100)),
+                ('subject', models.CharField(max_length=200)),
+                ('body', models.TextField()),
+                ('link', models.CharField(blank=True, max_length=200)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('sent', 'Sent'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.CharField(blank=True, max_length=200)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+                ('tutor', models.ForeignKey(blank=True, db_column='tutor', null=True, on_delete=django.db.models.deletion.PROTECT, to='exeatsapp.Tutor')),
+            ],
+            options={
+                'db_table': 'outbound_email',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboundemail',
+            index=models.Index(fields=['status', 'next_attempt'], name='outbound_email_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outboundemail',
+            index=models.Index(fields=['tutor', 'batch'], name='outbound_email_batch_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:24
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_summaries(apps, schema_editor):
+    Slot = apps.get_model('exeatsapp', 'Slot')
+    Student = apps.get_model('exeatsapp', 'Student')
+    slots = Slot.objects.filter(allocatedto=OuterRef('pk')).order_by().values('allocatedto')
+    attended = slots.filter(attended=True)
+    Student.objects.update(
+        last_slot=Subquery(slots.annotate(value=Max('start')).values('value')),
+        last_attended=Subquery(attended.annotate(value=Max('start')).values('value')),
+        slot_count=Coalesce(Subquery(slots.annotate(value=Count('id')).values('value')), 0),
+        attended_count=Coalesce(Subquery(attended.annotate(value=Count('id')).values('value')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exeatsapp', '0005_outboundemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='student',
+            name='attended_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='last_attended',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='last_slot',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='slot_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
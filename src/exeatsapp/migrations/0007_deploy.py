@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exeatsapp', '0006_student_slot_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Deploy',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('commit', models.CharField(blank=True, max_length=40)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed'), ('skipped', 'Skipped')], default='queued', max_length=10)),
+                ('timings', models.JSONField(default=dict)),
+                ('output', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'deploy',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='deploy',
+            index=models.Index(fields=['status', 'created'], name='deploy_status_idx'),
+        ),
+    ]
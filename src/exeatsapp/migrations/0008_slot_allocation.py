@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exeatsapp', '0007_deploy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Preference',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+            ],
+            options={
+                'db_table': 'preference',
+            },
+        ),
+        migrations.AddField(
+            model_name='tutor',
+            name='allocation_closes',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='tutor',
+            index=models.Index(condition=models.Q(('allocation_closes__isnull', False)), fields=['allocation_closes'], name='tutor_allocation_closes_idx'),
+        ),
+        migrations.AddField(
+            model_name='preference',
+            name='slot',
+            field=models.ForeignKey(db_column='slot', on_delete=django.db.models.deletion.CASCADE, to='exeatsapp.slot'),
+        ),
+        migrations.AddField(
+            model_name='preference',
+            name='student',
+            field=models.ForeignKey(db_column='student', on_delete=django.db.models.deletion.CASCADE, to='exeatsapp.student'),
+        ),
+        migrations.AddConstraint(
+            model_name='preference',
+            constraint=models.UniqueConstraint(fields=('student', 'slot'), name='preference_student_slot'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exeatsapp', '0008_slot_allocation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tutor',
+            name='api_token_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
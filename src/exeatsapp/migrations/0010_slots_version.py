@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exeatsapp', '0009_tutor_api_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotsVersion',
+            fields=[
+                ('tutor', models.OneToOneField(db_column='tutor', on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='exeatsapp.tutor')),
+                ('version', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'slots_version',
+            },
+        ),
+    ]
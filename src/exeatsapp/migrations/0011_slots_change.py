@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exeatsapp', '0010_slots_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotsChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField()),
+                ('changes', models.JSONField()),
+                ('tutor', models.ForeignKey(db_column='tutor', on_delete=django.db.models.deletion.CASCADE, to='exeatsapp.tutor')),
+            ],
+            options={
+                'db_table': 'slots_change',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='slotschange',
+            constraint=models.UniqueConstraint(fields=('tutor', 'version'), name='slots_change_version'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 
 class Exeat(models.Model):
@@ -18,6 +19,13 @@ class Slot(models.Model):
 
     class Meta:
         db_table = 'slot'
+        indexes = [
+            models.Index(fields=['tutor', 'start'], name='slot_tutor_start_idx'),
+            models.Index(fields=['allocatedto', 'start'], name='slot_allocatedto_start_idx'),
+            # only free slots are searched when students are choosing a time
+            models.Index(fields=['tutor', 'start'], name='slot_free_tutor_start_idx',
+                         condition=models.Q(allocatedto__isnull=True)),
+        ]
 
 
 class Student(models.Model):
@@ -25,9 +33,18 @@ class Student(models.Model):
     email = models.CharField(max_length=100)
     tutor = models.ForeignKey('Tutor', on_delete=models.PROTECT, db_column='tutor')
     alert = models.BooleanField(default=False)
+    # summary of the student's slots, kept up to date by students.refresh_summaries()
+    last_slot      = models.DateTimeField(blank=True, null=True)
+    last_attended  = models.DateTimeField(blank=True, null=True)
+    slot_count     = models.IntegerField(default=0)
+    attended_count = models.IntegerField(default=0)
 
     class Meta:
         db_table = 'student'
+        indexes = [
+            models.Index(fields=['email'], name='student_email_idx'),
+            models.Index(fields=['tutor', 'name'], name='student_tutor_name_idx'),
+        ]
 
 
 class Tutor(models.Model):
@@ -35,6 +52,122 @@ class Tutor(models.Model):
     password = models.CharField(max_length=100)
     isadmin = models.BooleanField()
     email = models.CharField(unique=True, max_length=100)
+    # while set, students rank the free slots they would like rather than booking one, and
+    # the slots are shared out at this time by allocate_slots
+    allocation_closes = models.DateTimeField(blank=True, null=True)
+    # sha256 of the secret part of the tutor's API token, see tutors.create_api_token()
+    api_token_hash = models.CharField(max_length=64, blank=True)
 
     class Meta:
         db_table = 'tutor'
+        indexes = [
+            models.Index(fields=['allocation_closes'], name='tutor_allocation_closes_idx',
+                         condition=models.Q(allocation_closes__isnull=False)),
+        ]
+
+
+class SlotsVersion(models.Model):
+    """ a count of the changes to anything shown in a tutor's slot tables, which the cached
+        tables are keyed on. Bumped in the database, so concurrent changes each get their own """
+    tutor   = models.OneToOneField('Tutor', on_delete=models.CASCADE, db_column='tutor',
+                                   primary_key=True)
+    version = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'slots_version'
+
+
+class SlotsChange(models.Model):
+    """ the slots taken and freed by a change of a tutor's slots version, as {slot id: taken},
+        for students' signup pages to catch up with. Changes which aren't only to bookings
+        aren't recorded, so a missing version means the page must be reloaded """
+    tutor   = models.ForeignKey('Tutor', on_delete=models.CASCADE, db_column='tutor')
+    version = models.IntegerField()
+    changes = models.JSONField()
+
+    class Meta:
+        db_table = 'slots_change'
+        constraints = [
+            models.UniqueConstraint(fields=['tutor', 'version'], name='slots_change_version'),
+        ]
+
+
+class Preference(models.Model):
+    """ a student's ranking of a free slot while their tutor is allocating slots, 1 being their
+        first choice """
+    student = models.ForeignKey('Student', on_delete=models.CASCADE, db_column='student')
+    slot    = models.ForeignKey('Slot', on_delete=models.CASCADE, db_column='slot')
+    rank    = models.PositiveSmallIntegerField()
+
+    class Meta:
+        db_table = 'preference'
+        constraints = [
+            models.UniqueConstraint(fields=['student', 'slot'], name='preference_student_slot'),
+        ]
+
+
+class OutboundEmail(models.Model):
+    """ an email waiting to be (or having been) sent by the send_queued_emails worker.
+        Any [link] in the body is replaced by `link` when the email is sent """
+    QUEUED = 'queued'
+    SENT   = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (SENT,   'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    tutor = models.ForeignKey('Tutor', on_delete=models.PROTECT, db_column='tutor',
+                              blank=True, null=True)
+    batch = models.CharField(max_length=32, blank=True)  # groups the emails of one mailing
+    to_email   = models.CharField(max_length=100)
+    from_email = models.CharField(max_length=200)
+    reply_to   = models.CharField(max_length=100, blank=True)
+    subject    = models.CharField(max_length=200)
+    body       = models.TextField()
+    link       = models.CharField(max_length=200, blank=True)
+    status     = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts   = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.CharField(max_length=200, blank=True)
+    created    = models.DateTimeField(auto_now_add=True)
+    sent       = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'outbound_email'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='outbound_email_due_idx'),
+            models.Index(fields=['tutor', 'batch'], name='outbound_email_batch_idx'),
+        ]
+
+
+class Deploy(models.Model):
+    """ an update of the application code requested by the deploy webhook, carried out by the
+        run_deploys worker. `timings` holds the seconds each phase took, in order """
+    QUEUED    = 'queued'
+    RUNNING   = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED    = 'failed'
+    SKIPPED   = 'skipped'  # superseded by a later deploy before it started
+    STATUS_CHOICES = (
+        (QUEUED,    'Queued'),
+        (RUNNING,   'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED,    'Failed'),
+        (SKIPPED,   'Skipped'),
+    )
+
+    commit   = models.CharField(max_length=40, blank=True)  # as given by the webhook
+    status   = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    timings  = models.JSONField(default=dict)
+    output   = models.TextField(blank=True)  # the end of a failed phase's output
+    created  = models.DateTimeField(auto_now_add=True)
+    started  = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'deploy'
+        indexes = [
+            models.Index(fields=['status', 'created'], name='deploy_status_idx'),
+        ]
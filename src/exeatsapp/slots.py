@@ -0,0 +1,256 @@
+import bisect
+import datetime
+from statistics import mode, median, StatisticsError
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .models import Tutor, Slot, Student, SlotsVersion, SlotsChange
+from .students import refresh_summaries
+
+# guards against a mistyped year generating an enormous series in a single request
+MAX_SLOTS_PER_REQUEST = 2000
+
+SUGGESTIONS_CACHE_KEY = 'slot_suggestions_{}'
+SUGGESTIONS_CACHE_SECONDS = 24 * 60 * 60
+
+# students' pages can catch up with this many changes of version, and older ones are deleted
+MAX_CHANGES_TO_CATCH_UP = 100
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def generate_slot_times(start, end, duration, until=None, weekdays=None):
+    """ returns a sorted list of naive start times for slots of `duration` minutes running from
+        `start` up to (but not including) `end`, always at least one slot.
+        If `until` (a date) is given, the same start-end window is repeated on every day from
+        `start` up to and including `until` whose weekday() is in `weekdays` (all days if
+        `weekdays` is empty), eg. 9-12 every weekday for two weeks.
+    """
+    step = datetime.timedelta(minutes=duration)
+    window = end - start
+    if until is None:
+        days = [start.date()]
+    else:
+        day_count = (until - start.date()).days + 1
+        days = [start.date() + datetime.timedelta(days=i) for i in range(max(day_count, 1))]
+        if weekdays:
+            days = [day for day in days if day.weekday() in weekdays]
+
+    times = []
+    for day in days:
+        time = datetime.datetime.combine(day, start.time())
+        day_end = time + window
+        first = True
+        while first or time < day_end:
+            first = False
+            times.append(time)
+            if len(times) > MAX_SLOTS_PER_REQUEST:
+                raise ValueError('Too many time slots requested, the limit is {} at once'
+                                 .format(MAX_SLOTS_PER_REQUEST))
+            time += step
+    return times
+
+
+def create_slots(tutor_id, times, location, duration):
+    """ inserts a slot for each of the naive, sorted `times` in one transaction, skipping any
+        which would overlap one of the tutor's existing slots.
+        Returns a tuple of (added_count, skipped_count)
+    """
+    if not times:
+        return 0, 0
+    starts = [timezone.make_aware(time) for time in times]
+    length = datetime.timedelta(minutes=duration)
+
+    with transaction.atomic():
+        # lock the tutor row so two concurrent submissions can't both pass the overlap check
+        tutor = Tutor.objects.select_for_update().get(id=tutor_id)
+        existing = list(Slot.objects.filter(tutor=tutor,
+                                            start__gt=starts[0] - length,
+                                            start__lt=starts[-1] + length)
+                                    .order_by('start')
+                                    .values_list('start', flat=True))
+        new_slots = [Slot(start=start, location=location, tutor=tutor)
+                     for start in starts if not overlaps_existing(existing, start, length)]
+        Slot.objects.bulk_create(new_slots)
+        slots_changed(tutor_id)
+
+    return len(new_slots), len(starts) - len(new_slots)
+
+
+def overlaps_existing(existing, start, length):
+    """ returns true if any of the sorted `existing` start times lies strictly within `length`
+        either side of `start`, meaning the two slots would overlap """
+    i = bisect.bisect_right(existing, start - length)
+    return i < len(existing) and existing[i] < start + length
+
+
+def book_slot(slot_id, student):
+    """ books a free future slot for the student, freeing any other future slot they hold, in a
+        constant number of queries. The slot is claimed with a conditional UPDATE, so when many
+        students try for the same slot at once exactly one of them gets it.
+        Returns the booked slot (with its tutor) or None if it was no longer available
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # locked so that two bookings by the same student at once, eg. from two tabs, are made
+        # one after the other, and the second frees the slot the first claimed
+        if not Student.objects.select_for_update().filter(id=student.id).values_list('id'):
+            return None
+        claimed = Slot.objects.filter(id=slot_id, tutor=student.tutor_id, allocatedto=None,
+                                      start__gte=now) \
+                              .update(allocatedto=student)
+        if not claimed:
+            return None
+        freed_ids = list(Slot.objects.filter(allocatedto=student, start__gte=now)
+                                     .exclude(id=slot_id)
+                                     .values_list('id', flat=True))
+        Slot.objects.filter(id__in=freed_ids).update(allocatedto=None)
+        changes = {slot_id: False for slot_id in freed_ids}
+        changes[int(slot_id)] = True
+        bookings_changed(student.tutor_id, changes)
+    refresh_summaries([student.id])
+    return Slot.objects.select_related('tutor').get(id=slot_id)
+
+
+def get_suggestions(tutor_id):
+    """ returns the (location, duration) to suggest for the tutor's next block of slots,
+        calculated once and then cached until their slots change """
+    key = SUGGESTIONS_CACHE_KEY.format(tutor_id)
+    suggestions = cache.get(key)
+    if suggestions is None:
+        suggestions = calculate_suggestions(tutor_id)
+        cache.set(key, suggestions, SUGGESTIONS_CACHE_SECONDS)
+    return suggestions
+
+
+def calculate_suggestions(tutor_id):
+    """ suggests the location of the tutor's latest slot and the most common gap between their
+        last 50 slots """
+    recent = list(Slot.objects.filter(tutor=tutor_id)
+                              .order_by('-start')
+                              .values_list('start', 'location')[0:50])
+    if not recent:
+        return '', 10
+
+    minute_diffs = [(recent[i][0] - recent[i + 1][0]).total_seconds() / 60
+                    for i in range(len(recent) - 1)]
+    try:
+        duration = int(mode(minute_diffs))
+    except StatisticsError:  # if there's no unique most popular duration, use the middle one
+        duration = int(median(minute_diffs)) if minute_diffs else 10
+    return recent[0][1], duration
+
+
+def get_slots_version(tutor_id):
+    """ returns a number which changes whenever anything shown in the tutor's slot tables does """
+    return SlotsVersion.objects.filter(tutor=tutor_id) \
+                               .values_list('version', flat=True).first() or 0
+
+
+def slots_changed(tutor_id):
+    """ must be called whenever slots are added to or removed from the tutor's list """
+    transaction.on_commit(lambda: cache.delete(SUGGESTIONS_CACHE_KEY.format(tutor_id)))
+    bookings_changed(tutor_id)
+
+
+def bookings_changed(tutor_id, changes=None):
+    """ must be called whenever a booking, attendance or student shown against the tutor's
+        slots changes, and within the change's transaction if it has one, so that changes to
+        the same slots are numbered in the order they were made. Unless the change adds or
+        removes slots, or frees slots without knowing which, `changes` should map the ids of
+        any slots taken to True and freed to False, so that students' signup pages can catch
+        up without reloading. It is {} for changes, eg. to attendance, which they don't show """
+    with transaction.atomic():
+        version = bump_slots_version(tutor_id)
+        if changes is not None:
+            SlotsChange.objects.create(tutor_id=tutor_id, version=version, changes=changes)
+        if version % MAX_CHANGES_TO_CATCH_UP == 0:
+            SlotsChange.objects.filter(tutor=tutor_id,
+                                       version__lte=version - MAX_CHANGES_TO_CATCH_UP).delete()
+
+
+def bump_slots_version(tutor_id):
+    """ adds one to the tutor's slots version and returns it. The row stays locked until the
+        transaction ends, so no two changes can be given the same version """
+    with transaction.atomic():
+        if not SlotsVersion.objects.filter(tutor=tutor_id).update(version=F('version') + 1):
+            try:
+                with transaction.atomic():
+                    SlotsVersion.objects.create(tutor_id=tutor_id, version=1)
+                    return 1
+            except IntegrityError:  # created by a concurrent change first
+                SlotsVersion.objects.filter(tutor=tutor_id).update(version=F('version') + 1)
+        return SlotsVersion.objects.filter(tutor=tutor_id) \
+                                   .values_list('version', flat=True).get()
+
+
+def get_availability_changes(tutor_id, since):
+    """ returns a tuple of the tutor's current slots version and a dict of the slots taken (True)
+        or freed (False) since version `since`. The dict is None when the changes aren't all
+        known, eg. slots have been added or `since` is too old, so the page must be reloaded """
+    version = get_slots_version(tutor_id)
+    if since == version:
+        return version, {}
+    if not version - MAX_CHANGES_TO_CATCH_UP <= since < version:
+        return version, None
+
+    found = list(SlotsChange.objects.filter(tutor=tutor_id, version__gt=since,
+                                            version__lte=version)
+                                    .order_by('version')
+                                    .values_list('changes', flat=True))
+    if len(found) < version - since:
+        return version, None
+    changes = {}
+    for change in found:
+        # the slot ids come back from the JSON as strings
+        changes.update((int(slot_id), taken) for slot_id, taken in change.items())
+    return version, changes
+
+
+class SlotPage:
+    """ a page of slots, fetched lazily so that nothing is queried if the page is cached, from a
+        queryset ordered by descending (start, id) and starting after the `before` cursor """
+    def __init__(self, queryset, before=None, size=100):
+        self.queryset = queryset
+        self.size = size
+        position = decode_cursor(before) if before else None
+        if position:
+            start, slot_id = position
+            self.queryset = queryset.filter(Q(start__lt=start) | Q(start=start, id__lt=slot_id))
+
+    @cached_property
+    def rows(self):
+        return list(self.queryset.order_by('-start', '-id')[:self.size + 1])
+
+    @property
+    def slots(self):
+        return self.rows[:self.size]
+
+    @property
+    def next_cursor(self):
+        """ the cursor for the following page, or None if this is the last one """
+        if len(self.rows) > self.size:
+            return encode_cursor(self.rows[self.size - 1])
+        return None
+
+
+def encode_cursor(slot):
+    """ returns an opaque position after `slot` in a list ordered by (start, id) """
+    microseconds = (slot.start - EPOCH) // datetime.timedelta(microseconds=1)
+    return '{}.{}'.format(microseconds, slot.id)
+
+
+def decode_cursor(cursor):
+    """ returns the (start, id) position encoded in a cursor, or None if it is malformed """
+    try:
+        microseconds, slot_id = map(int, cursor.split('.'))
+        start = EPOCH + datetime.timedelta(microseconds=microseconds)
+    except (ValueError, OverflowError):
+        return None
+    if not 0 < slot_id < 2 ** 31:  # beyond what the database can compare with an id
+        return None
+    return start, slot_id
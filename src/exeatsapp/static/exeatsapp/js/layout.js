@@ -0,0 +1,43 @@
+$(function() {
+  $(".datetimepicker").datetimepicker({
+    controlType: 'select',
+    oneLine: true,
+    dateFormat: 'dd/mm/y',
+    timeFormat: 'HH:mm',
+    stepMinute: 5
+  });
+  $(".datepicker").datepicker({
+    dateFormat: 'dd/mm/y'
+  });
+
+  // range selection for checkboxes within a form
+  $('body').on('click', '.checkbox', function(e){
+    $checkboxes   = $(this).parents('form').find('.checkbox')
+    $old_checkbox = $checkboxes.filter('.last_checkbox_clicked').removeClass('last_checkbox_clicked')
+    $new_checkbox = $(this).addClass('last_checkbox_clicked')
+    if( e.shiftKey )
+    {
+      $checkboxes.each(function(){
+        index     = $checkboxes.index($(this))
+        old_index = $checkboxes.index($old_checkbox)
+        new_index = $checkboxes.index($new_checkbox)
+        if( index < Math.max(old_index, new_index) && index > Math.min(old_index, new_index))
+        {
+          $(this).prop('checked', $new_checkbox.prop('checked'))
+          $old_checkbox.prop('checked', $new_checkbox.prop('checked'))
+        }
+      })
+    }
+  })
+});
+
+function toggle_flag(element, slot_id) {
+  var xmlhttp = new XMLHttpRequest();
+  xmlhttp.onreadystatechange = function() {
+    if (xmlhttp.readyState == XMLHttpRequest.DONE && xmlhttp.status == 200) {
+      element.classList.toggle('confirmed');
+    }
+  };
+  xmlhttp.open("GET", element.getAttribute("href"), true);
+  xmlhttp.send();
+}
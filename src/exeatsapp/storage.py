@@ -0,0 +1,45 @@
+import gzip
+import io
+
+from pipeline.storage import PipelineManifestStorage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.json', '.map')
+
+
+class CompressedManifestStorage(PipelineManifestStorage):
+    """ static files storage that gives each file a name containing a hash of its contents, so
+        it can be cached forever, and writes gzip and, if the brotli package is installed,
+        brotli compressed copies of the text files alongside for nginx to serve as they are """
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = set()
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if hashed_name and not isinstance(processed, Exception):
+                hashed_names.add(hashed_name)
+            yield name, hashed_name, processed
+
+        if not dry_run:
+            for hashed_name in sorted(hashed_names):
+                if hashed_name.endswith(COMPRESSIBLE_EXTENSIONS):
+                    self.write_compressed(hashed_name)
+
+    def write_compressed(self, name):
+        with self.open(name) as original:
+            content = original.read()
+        compressed = io.BytesIO()
+        # mtime=0 keeps the output the same between deploys of the same file
+        with gzip.GzipFile(fileobj=compressed, mode='wb', compresslevel=9, mtime=0) as output:
+            output.write(content)
+        self.write_if_smaller(name + '.gz', content, compressed.getvalue())
+        if brotli:
+            self.write_if_smaller(name + '.br', content, brotli.compress(content))
+
+    def write_if_smaller(self, name, content, compressed):
+        if len(compressed) < len(content):
+            with open(self.path(name), 'wb') as output:
+                output.write(compressed)
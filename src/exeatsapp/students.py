@@ -0,0 +1,178 @@
+import codecs
+import csv
+import datetime
+import io
+import re
+from collections import namedtuple
+from itertools import chain, islice
+
+from django.db import transaction
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Slot, Student
+
+ImportReport = namedtuple('ImportReport', ['added', 'skipped', 'invalid'])
+
+ANGLE_BRACKETS_PATTERN = re.compile(r'\s*(?P<name>[^,\<\>]+?)\s*\<(?P<email>.+?@.+?)\>\s*')
+CAMSIS_HEADINGS = ('Last Name', 'First Name - Pref/Prim', 'CRSID')
+DETECTION_LINES = 5
+
+RECENT_DAYS = 14  # students with a slot in the last fortnight have responded to the last email
+
+
+def normalise_email(email):
+    """ treats a bare CRSID as a cam.ac.uk email address """
+    return email if '@' in email else '{}@cam.ac.uk'.format(email)
+
+
+def import_students(tutor_id, details):
+    """ adds a student for each (name, email) in `details` whose email isn't already known,
+        checking for existing students in one query and inserting the rest in batches.
+        Returns an ImportReport of the (name, email) tuples added, skipped and invalid
+    """
+    rows, invalid = [], []
+    for name, email in details:
+        name, email = name.strip(), normalise_email(email.strip())
+        if is_valid_details(name, email):
+            rows.append((name, email))
+        else:
+            invalid.append((name, email))
+
+    with transaction.atomic():
+        emails = {email for _, email in rows}
+        existing = set(Student.objects.filter(email__in=emails).values_list('email', flat=True))
+        added, skipped = [], []
+        for name, email in rows:
+            if email in existing:
+                skipped.append((name, email))
+            else:
+                added.append((name, email))
+                existing.add(email)  # so a repeated line in the upload is only added once
+        Student.objects.bulk_create(Student(name=name, email=email, tutor_id=tutor_id)
+                                    for name, email in added)
+
+    return ImportReport(added, skipped, invalid)
+
+
+def is_valid_details(name, email):
+    """ checks a stripped and normalised name and email will do for a student """
+    return bool(name) and not email.startswith('@') and ' ' not in email and \
+        max(len(name), len(email)) <= 100
+
+
+def parse_student_details(source, errors=None):
+    """ lazily yields (name, email) tuples from text or an uploaded file with format one of:
+        1) 'Alice Smith<alice@smith.com>, Bob Smith<bob@smith.com>'
+               (all one line, as produced by the student email list builder)
+        2) 'Alice Smith, alice@smith.com
+            Bob Smith, bob@smith.com'
+        3) 'Smith, Alice, alice@smith.com
+            Smith, Bob, bob@smith.com'
+        4) a tab-separated CamSIS export including its header row
+        The format is detected from the first few lines. Fields may be quoted as in a CSV file.
+        The numbers of any lines which can't be read are appended to `errors`
+    """
+    errors = errors if errors is not None else []
+    lines = iter_lines(source)
+    first_lines = list(islice(lines, DETECTION_LINES))
+    lines = chain(first_lines, lines)
+
+    if any(ANGLE_BRACKETS_PATTERN.search(line) for line in first_lines):
+        for line in lines:
+            for match in ANGLE_BRACKETS_PATTERN.finditer(line):
+                yield match.group('name'), match.group('email')
+        return
+
+    delimiter = '\t' if any('\t' in line for line in first_lines) else ','
+    reader = csv.reader(lines, delimiter=delimiter, skipinitialspace=True)
+    column_lookup = None
+    for parts in reader:
+        parts = [part.strip() for part in parts]
+        if not any(parts):
+            continue
+
+        if CAMSIS_HEADINGS[1] in parts:
+            try:
+                column_lookup = [parts.index(heading) for heading in CAMSIS_HEADINGS]
+            except ValueError:
+                errors.append(reader.line_num)
+            continue
+
+        if column_lookup:
+            if len(parts) <= max(column_lookup):
+                errors.append(reader.line_num)
+                continue
+            parts = [parts[i] for i in column_lookup]
+
+        if len(parts) == 3:
+            yield '{} {}'.format(parts[1], parts[0]), parts[2]
+        elif len(parts) == 2:
+            yield parts[0], parts[1]
+        else:
+            errors.append(reader.line_num)
+
+
+def iter_lines(source):
+    """ returns an iterator over the lines of a string or of a (binary) uploaded file """
+    if isinstance(source, str):
+        return io.StringIO(source, newline=None)
+    return codecs.iterdecode(source, 'utf-8-sig', errors='replace')
+
+
+def refresh_summaries(student_ids):
+    """ recalculates the slot summary columns of the given students from their slots in a single
+        UPDATE. Must be called whenever their bookings or attendance change """
+    slots = Slot.objects.filter(allocatedto=OuterRef('pk')).order_by().values('allocatedto')
+    attended = slots.filter(attended=True)
+    Student.objects.filter(id__in=student_ids).update(
+        last_slot=Subquery(slots.annotate(value=Max('start')).values('value')),
+        last_attended=Subquery(attended.annotate(value=Max('start')).values('value')),
+        slot_count=Coalesce(Subquery(slots.annotate(value=Count('id')).values('value')), 0),
+        attended_count=Coalesce(Subquery(attended.annotate(value=Count('id')).values('value')), 0),
+    )
+
+
+def get_segment_bounds(now):
+    """ returns the times separating recent, today's and tomorrow's slots from the rest """
+    midnight = timezone.localtime(now).replace(hour=0, minute=0, second=0, microsecond=0)
+    return {'recent': now - datetime.timedelta(days=RECENT_DAYS),
+            'tomorrow': midnight + datetime.timedelta(days=1),
+            'day_after': midnight + datetime.timedelta(days=2)}
+
+
+def get_segment_filter(segment, now):
+    """ returns a Q selecting the students in the named segment from their slot summary.
+        Raises KeyError for an unknown segment """
+    bounds = get_segment_bounds(now)
+    past_recent = Q(last_slot__gt=bounds['recent'], last_slot__lte=now)
+    not_attended = Q(last_attended__isnull=True) | Q(last_attended__lt=F('last_slot'))
+    return {
+        'all': Q(),
+        'no_response': Q(last_slot__isnull=True) | Q(last_slot__lte=bounds['recent']),
+        'missed': past_recent & not_attended,
+        'seen': past_recent & Q(last_attended=F('last_slot')),
+        'prospective': Q(last_slot__gt=now),
+        'today': Q(last_slot__gt=now, last_slot__lt=bounds['tomorrow']),
+        'tomorrow': Q(last_slot__gte=bounds['tomorrow'], last_slot__lt=bounds['day_after']),
+    }[segment]
+
+
+def get_segments(student, now):
+    """ returns the names of the segments the student is in, matching get_segment_filter() but
+        without a query, so the emails page can show which students a segment selects """
+    bounds = get_segment_bounds(now)
+    last_slot = student.last_slot
+    segments = ['all']
+    if not last_slot or last_slot <= bounds['recent']:
+        segments.append('no_response')
+    elif last_slot <= now:
+        segments.append('seen' if student.last_attended == last_slot else 'missed')
+    else:
+        segments.append('prospective')
+        if last_slot < bounds['tomorrow']:
+            segments.append('today')
+        elif last_slot < bounds['day_after']:
+            segments.append('tomorrow')
+    return segments
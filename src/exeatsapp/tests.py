@@ -1,3 +1,461 @@
-# from django.test import TestCase
+import datetime
+import json
+import threading
+import time
+import unittest
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import int_to_base36
+
+from .allocation import allocate_slots, match, save_preferences, set_allocation_closes
+from .links import (get_feed_hash_for_tutor, get_hash_for_student, get_legacy_hash_for_student,
+                    get_student_for_hash, get_tutor_id_for_feed_hash, sign)
+from .models import Tutor, Slot, Student, Preference
+from .slots import book_slot, create_slots, get_slots_version
+from .tutors import create_api_token, get_tutor
+
+# each test starts with an empty cache of its own, so no slot table fragment is already cached
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class SlotListingQueryTests(TestCase):
+    """ the slot listing pages make the same number of queries however many slots are booked """
+
+    def setUp(self):
+        cache.clear()
+        self.tutor = Tutor.objects.create(name='Tutor', password='password', isadmin=False,
+                                          email='tutor@example.com')
+        self.client.post(reverse('exeatsapp:login'),
+                         {'__email': 'tutor@example.com', '__password': 'password'})
+        self.student = Student.objects.create(name='Student', email='student@example.com',
+                                              tutor=self.tutor)
+
+    def book_slots(self, count):
+        """ adds `count` booked slots in the past and as many in the future, each with a
+            student of their own, and a free future slot """
+        now = timezone.now()
+        students = [Student.objects.create(name='Student {}'.format(i),
+                                           email='student{}@example.com'.format(i),
+                                           tutor=self.tutor)
+                    for i in range(count)]
+        Slot.objects.bulk_create(
+            Slot(tutor=self.tutor, location='Study', allocatedto=student,
+                 start=now + datetime.timedelta(days=days, minutes=i))
+            for i, student in enumerate(students) for days in (-1, 1))
+        Slot.objects.create(tutor=self.tutor, location='Study',
+                            start=now + datetime.timedelta(days=2))
+
+    def assertPageQueries(self, url, expected):
+        for count in (1, 20):
+            with self.subTest(booked=count):
+                Slot.objects.all().delete()
+                Student.objects.exclude(id=self.student.id).delete()
+                self.book_slots(count)
+                cache.clear()
+                get_tutor(self.tutor.id)  # as it would be after the tutor's first request
+                with self.assertNumQueries(expected):
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertContains(response, 'Student {}'.format(count - 1))
+
+    def test_view(self):
+        self.assertPageQueries(reverse('exeatsapp:view'), 2)
+
+    def test_history(self):
+        self.assertPageQueries(reverse('exeatsapp:history'), 2)
+
+    def test_times(self):
+        self.assertPageQueries(reverse('exeatsapp:times'), 2)
+
+    def test_signup(self):
+        self.assertPageQueries(reverse('exeatsapp:signup',
+                                       kwargs={'hash': get_hash_for_student(self.student)}), 4)
+
+    def test_cached_view(self):
+        """ once the slot table is cached, only the slots version is looked up """
+        self.book_slots(20)
+        self.client.get(reverse('exeatsapp:view'))
+        with self.assertNumQueries(1):
+            self.client.get(reverse('exeatsapp:view'))
+
+
+# sqlite's in-memory test database raises an error rather than waiting while another
+# connection writes, so the bookings can't really be made at once there
+@unittest.skipUnless(connection.vendor == 'postgresql', 'needs concurrent writes')
+class ConcurrentBookingTests(TransactionTestCase):
+    """ bookings made at the same moment, each in its own thread and database connection """
+
+    def setUp(self):
+        self.tutor = Tutor.objects.create(name='Tutor', password='password', isadmin=False,
+                                          email='tutor@example.com')
+        self.start = timezone.now() + datetime.timedelta(days=1)
+
+    def book_at_once(self, bookings):
+        """ calls book_slot(slot_id, student) for each of the `bookings` in threads released
+            together, returning the slots booked, or None for those which weren't """
+        barrier = threading.Barrier(len(bookings))
+        results = [None] * len(bookings)
+        errors = []
+
+        def book(i, slot_id, student):
+            try:
+                barrier.wait()
+                results[i] = book_slot(slot_id, student)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=book, args=(i, slot_id, student))
+                   for i, (slot_id, student) in enumerate(bookings)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def test_one_slot(self):
+        slot = Slot.objects.create(tutor=self.tutor, location='Study', start=self.start)
+        students = [Student.objects.create(name='Student {}'.format(i),
+                                           email='student{}@example.com'.format(i),
+                                           tutor=self.tutor)
+                    for i in range(20)]
+        results = self.book_at_once([(slot.id, student) for student in students])
+        winners = [student for student, result in zip(students, results) if result]
+        self.assertEqual(len(winners), 1)
+        slot.refresh_from_db()
+        self.assertEqual(slot.allocatedto_id, winners[0].id)
+
+    def test_one_student(self):
+        slots = [Slot.objects.create(tutor=self.tutor, location='Study',
+                                     start=self.start + datetime.timedelta(minutes=i))
+                 for i in range(10)]
+        student = Student.objects.create(name='Student', email='student@example.com',
+                                         tutor=self.tutor)
+        results = self.book_at_once([(slot.id, student) for slot in slots])
+        self.assertTrue(any(results))
+        self.assertEqual(Slot.objects.filter(allocatedto=student).count(), 1)
+
+
+class HistoryExportTests(TransactionTestCase):
+    """ the export is served whole under ASGI, whose handler would otherwise iterate it, and
+        so run its queries, in the event loop """
+
+    def setUp(self):
+        self.tutor = Tutor.objects.create(name='Tutor', password='password', isadmin=False,
+                                          email='tutor@example.com')
+        self.client.post(reverse('exeatsapp:login'),
+                         {'__email': 'tutor@example.com', '__password': 'password'})
+        student = Student.objects.create(name='Student', email='student@example.com',
+                                         tutor=self.tutor)
+        for days in range(1, 4):
+            Slot.objects.create(tutor=self.tutor, location='Study', allocatedto=student,
+                                start=timezone.now() - datetime.timedelta(days=days))
+
+    def get_over_asgi(self, path):
+        """ returns (status, body) of a GET of the path through django's ASGI handler """
+        cookie = self.client.cookies[settings.SESSION_COOKIE_NAME]
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'',
+            'headers': [(b'host', b'testserver'),
+                        (b'cookie', '{}={}'.format(cookie.key, cookie.value).encode())],
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        async_to_sync(ASGIHandler())(scope, receive, send)
+        status = next(m['status'] for m in messages if m['type'] == 'http.response.start')
+        body = b''.join(m.get('body', b'') for m in messages
+                        if m['type'] == 'http.response.body')
+        return status, body.decode('utf-8')
+
+    def test_csv(self):
+        status, body = self.get_over_asgi(reverse('exeatsapp:history_export',
+                                                  kwargs={'format': 'csv'}))
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body.splitlines()), 4)
+        self.assertIn('student@example.com', body)
+
+    def test_json(self):
+        status, body = self.get_over_asgi(reverse('exeatsapp:history_export',
+                                                  kwargs={'format': 'json'}))
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)), 3)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class AvailabilityTests(TestCase):
+    """ students' signup pages catch up with changes, only reloading when slots are added or
+        removed """
+
+    def setUp(self):
+        self.tutor = Tutor.objects.create(name='Tutor', password='password', isadmin=False,
+                                          email='tutor@example.com')
+        self.client.post(reverse('exeatsapp:login'),
+                         {'__email': 'tutor@example.com', '__password': 'password'})
+        self.student = Student.objects.create(name='Student', email='student@example.com',
+                                              tutor=self.tutor)
+        self.slots = [Slot.objects.create(tutor=self.tutor, location='Study',
+                                          start=timezone.now() + datetime.timedelta(days=1,
+                                                                                    minutes=i))
+                      for i in range(2)]
+        self.url = reverse('exeatsapp:availability',
+                           kwargs={'hash': get_hash_for_student(self.student)})
+        self.version = get_slots_version(self.tutor.id)
+
+    def get_changes(self):
+        return self.client.get(self.url, {'since': self.version}).json()
+
+    def test_bookings(self):
+        book_slot(self.slots[0].id, self.student)
+        book_slot(self.slots[1].id, self.student)
+        self.assertEqual(self.get_changes()['changes'], {str(self.slots[0].id): 'free',
+                                                         str(self.slots[1].id): 'taken'})
+
+    def test_attendance_and_alerts(self):
+        book_slot(self.slots[0].id, self.student)
+        self.client.get(reverse('exeatsapp:toggle_attended', kwargs={'id': self.slots[0].id}))
+        self.client.get(reverse('exeatsapp:toggle_alert', kwargs={'id': self.student.id}))
+        response = self.get_changes()
+        self.assertEqual(response['changes'], {str(self.slots[0].id): 'taken'})
+        self.assertEqual(response['version'], self.version + 3)
+
+    def test_slots_added(self):
+        create_slots(self.tutor.id, [datetime.datetime.now() + datetime.timedelta(days=2)],
+                     'Study', 10)
+        self.assertTrue(self.get_changes()['reload'])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class SlotsApiTests(TestCase):
+    """ the JSON API for changing many slots at once """
+
+    def setUp(self):
+        cache.clear()
+        self.tutor = Tutor.objects.create(name='Tutor', password='password', isadmin=False,
+                                          email='tutor@example.com')
+        self.token = create_api_token(self.tutor)
+        self.start = timezone.now().replace(second=0, microsecond=0) + datetime.timedelta(days=1)
+
+    def post(self, body, token=None):
+        return self.client.post(reverse('exeatsapp:api_slots'), json.dumps(body),
+                                content_type='application/json',
+                                HTTP_AUTHORIZATION='Bearer {}'.format(token or self.token))
+
+    def at(self, minutes):
+        return (self.start + datetime.timedelta(minutes=minutes)).isoformat()
+
+    def test_token_required(self):
+        body = {'create': [{'start': self.at(0), 'location': 'Study'}]}
+        response = self.client.post(reverse('exeatsapp:api_slots'), json.dumps(body),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.post(body, token='not-the-token').status_code, 401)
+        self.assertFalse(Slot.objects.exists())
+
+    def test_item_errors(self):
+        other = Tutor.objects.create(name='Other', password='password', isadmin=False,
+                                     email='other@example.com')
+        theirs = Slot.objects.create(tutor=other, location='Study', start=self.start)
+        response = self.post({'create': [{'start': self.at(0), 'location': 'Study'},
+                                         {'start': 'tomorrow', 'location': 'Study'},
+                                         {'start': self.at(30)}],
+                              'update': [{'id': theirs.id, 'location': 'Hall'}],
+                              'delete': [theirs.id, 'one']}).json()
+        self.assertEqual([result['ok'] for result in response['create']], [True, False, False])
+        self.assertEqual([result['ok'] for result in response['update']], [False])
+        self.assertEqual([result['ok'] for result in response['delete']], [False, False])
+        self.assertEqual(Slot.objects.filter(tutor=self.tutor).count(), 1)
+        theirs.refresh_from_db()
+        self.assertEqual(theirs.location, 'Study')
+
+    def test_one_future_booking(self):
+        student = Student.objects.create(name='Student', email='student@example.com',
+                                         tutor=self.tutor)
+        held, first, second = [
+            Slot.objects.create(tutor=self.tutor, location='Study',
+                                start=self.start + datetime.timedelta(minutes=minutes))
+            for minutes in (0, 10, 20)]
+        held.allocatedto = student
+        held.save()
+        response = self.post({'update': [{'id': first.id, 'student': student.id},
+                                         {'id': second.id, 'student': student.id}]}).json()
+        self.assertEqual([result['ok'] for result in response['update']], [True, False])
+        self.assertEqual(list(Slot.objects.filter(allocatedto=student)
+                                          .values_list('id', flat=True)), [first.id])
+
+    def test_overlap(self):
+        slots = [Slot.objects.create(tutor=self.tutor, location='Study',
+                                     start=self.start + datetime.timedelta(minutes=minutes))
+                 for minutes in (0, 15, 30)]  # so slots are taken to last 15 minutes
+        response = self.post({'create': [{'start': self.at(20), 'location': 'Study'},
+                                         {'start': self.at(60), 'location': 'Study'}],
+                              'update': [{'id': slots[2].id, 'start': self.at(10)},
+                                         {'id': slots[2].id, 'start': self.at(35)}]}).json()
+        self.assertEqual([result['ok'] for result in response['create']], [False, True])
+        self.assertEqual([result['ok'] for result in response['update']], [False, True])
+        slots[2].refresh_from_db()
+        self.assertEqual(slots[2].start, self.start + datetime.timedelta(minutes=35))
+
+    def test_clock_changes(self):
+        """ local times which the clocks skip or repeat are ambiguous without an offset """
+        response = self.post({'create': [{'start': '2027-03-28T01:30', 'location': 'Study'},
+                                         {'start': '2027-10-31T01:30', 'location': 'Study'},
+                                         {'start': '2027-10-31T01:30+01:00',
+                                          'location': 'Study'}]}).json()
+        self.assertEqual([result['ok'] for result in response['create']], [False, False, True])
+        self.assertEqual(Slot.objects.get().start,
+                         datetime.datetime(2027, 10, 31, 0, 30, tzinfo=datetime.timezone.utc))
+
+
+class MatchTests(TestCase):
+    """ the matching of students to the slots they ranked """
+
+    def test_lowest_total_cost(self):
+        allocation = match([('a', [(1, 1), (2, 2)]), ('b', [(1, 1), (2, 5)])])
+        self.assertEqual(allocation, {'a': 2, 'b': 1})
+
+    def test_most_students(self):
+        """ a student's first choice is given up if that lets another student have a slot """
+        allocation = match([('a', [(1, 1), (2, 2)]), ('b', [(1, 1)])])
+        self.assertEqual(allocation, {'a': 2, 'b': 1})
+
+    def test_ties(self):
+        allocation = match([('a', [(1, 1), (2, 1)]), ('b', [(1, 1), (2, 1)]),
+                            ('c', [(1, 2), (3, 1)])])
+        self.assertEqual(set(allocation), {'a', 'b', 'c'})
+        self.assertEqual(sorted(allocation.values()), [1, 2, 3])
+
+    def test_more_students_than_slots(self):
+        allocation = match([(student, [(1, 1), (2, 2)]) for student in 'abcd'])
+        self.assertEqual(len(allocation), 2)
+        self.assertEqual(sorted(allocation.values()), [1, 2])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class AllocationTests(TestCase):
+    """ ranking slots while the tutor allocates them by preference """
+
+    def setUp(self):
+        cache.clear()
+        self.tutor = Tutor.objects.create(name='Tutor', password='password', isadmin=False,
+                                          email='tutor@example.com')
+        self.students = [Student.objects.create(name='Student {}'.format(i),
+                                                email='student{}@example.com'.format(i),
+                                                tutor=self.tutor)
+                         for i in range(3)]
+        self.slots = [Slot.objects.create(tutor=self.tutor, location='Study',
+                                          start=timezone.now() + datetime.timedelta(days=1,
+                                                                                    minutes=i))
+                      for i in range(2)]
+        set_allocation_closes(self.tutor, timezone.now() + datetime.timedelta(days=1))
+
+    def submit(self, ranks):
+        url = reverse('exeatsapp:signup', kwargs={'hash': get_hash_for_student(self.students[0])})
+        response = self.client.post(url, {'rank_{}'.format(slot_id): rank
+                                          for slot_id, rank in ranks.items()},
+                                    HTTP_REFERER=url, follow=True)
+        return [str(message) for message in response.context['messages']]
+
+    def test_ranks_saved(self):
+        self.assertIn('Your choices have been saved', self.submit({self.slots[1].id: 1,
+                                                                   self.slots[0].id: 2})[0])
+        self.assertEqual(list(Preference.objects.order_by('rank').values_list('slot_id',
+                                                                              flat=True)),
+                         [self.slots[1].id, self.slots[0].id])
+
+    def test_invalid_ranks(self):
+        for rank in (0, 6, 'first'):
+            with self.subTest(rank=rank):
+                self.assertEqual(self.submit({self.slots[0].id: rank}),
+                                 ['Please number your choices from 1 to 5.'])
+        self.assertFalse(Preference.objects.exists())
+
+    def test_duplicate_ranks(self):
+        self.assertEqual(self.submit({self.slots[0].id: 1, self.slots[1].id: 1}),
+                         ['Please give each of your choices a different number.'])
+        self.assertFalse(Preference.objects.exists())
+
+    def test_allocate(self):
+        for student in self.students:
+            save_preferences(student, [slot.id for slot in self.slots])
+        self.assertIsNone(allocate_slots(self.tutor.id))  # not closed yet
+        Tutor.objects.filter(id=self.tutor.id).update(allocation_closes=timezone.now())
+        allocation = allocate_slots(self.tutor.id, seed=1)
+        self.assertEqual(len(allocation), 2)
+        self.assertEqual(sorted(allocation.values()), [slot.id for slot in self.slots])
+        self.tutor.refresh_from_db()
+        self.assertIsNone(self.tutor.allocation_closes)
+        self.assertFalse(Preference.objects.exists())
+        self.assertEqual(dict(Slot.objects.values_list('allocatedto_id', 'id')), allocation)
+
+
+@override_settings(SIGNUP_LINK_KEYS=['current'], SIGNUP_LINK_MAX_AGE_DAYS=None)
+class LinkTests(TestCase):
+    """ the signed links students sign up with and tutors subscribe to their calendars with """
+
+    def setUp(self):
+        self.tutor = Tutor.objects.create(name='Tutor', password='password', isadmin=False,
+                                          email='tutor@example.com')
+        self.student = Student.objects.create(name='Student', email='student@example.com',
+                                              tutor=self.tutor)
+
+    def test_valid(self):
+        self.assertEqual(get_student_for_hash(get_hash_for_student(self.student)), self.student)
+        with override_settings(SIGNUP_LINK_MAX_AGE_DAYS=7):
+            self.assertEqual(get_student_for_hash(get_hash_for_student(self.student)),
+                             self.student)
+
+    def test_tampered(self):
+        other = Student.objects.create(name='Other', email='other@example.com',
+                                       tutor=self.tutor)
+        hash = get_hash_for_student(self.student)
+        payload, signature = hash.rsplit('.', 1)
+        self.assertIsNone(get_student_for_hash('{}.{}.{}'.format(other.id, self.tutor.id,
+                                                                 signature)))
+        changed = ('A' if signature[0] != 'A' else 'B') + signature[1:]
+        self.assertIsNone(get_student_for_hash('{}.{}'.format(payload, changed)))
+
+    def test_expired(self):
+        payload = '{}.{}.{}'.format(self.student.id, self.tutor.id,
+                                    int_to_base36(int(time.time()) - 60))
+        hash = '{}.{}'.format(payload, sign(payload, 'current'))
+        self.assertIsNone(get_student_for_hash(hash))
+
+    def test_key_rotation(self):
+        with override_settings(SIGNUP_LINK_KEYS=['old']):
+            hash = get_hash_for_student(self.student)
+        with override_settings(SIGNUP_LINK_KEYS=['new', 'old']):
+            self.assertEqual(get_student_for_hash(hash), self.student)
+        with override_settings(SIGNUP_LINK_KEYS=['new']):
+            self.assertIsNone(get_student_for_hash(hash))
+
+    def test_legacy(self):
+        hash = get_legacy_hash_for_student(self.student)
+        with override_settings(SIGNUP_LINK_ACCEPT_LEGACY=True):
+            self.assertEqual(get_student_for_hash(hash), self.student)
+            self.assertIsNone(get_student_for_hash(hash[:-1] + ('0' if hash[-1] != '0' else '1')))
+        with override_settings(SIGNUP_LINK_ACCEPT_LEGACY=False):
+            self.assertIsNone(get_student_for_hash(hash))
+
+    def test_feed(self):
+        hash = get_feed_hash_for_tutor(self.tutor.id)
+        self.assertEqual(get_tutor_id_for_feed_hash(hash), self.tutor.id)
+        self.assertIsNone(get_tutor_id_for_feed_hash(hash.replace(str(self.tutor.id),
+                                                                  str(self.tutor.id + 1), 1)))
+        # a student's signup link can't be used as a feed link
+        self.assertIsNone(get_tutor_id_for_feed_hash(get_hash_for_student(self.student)))
@@ -0,0 +1,108 @@
+import asyncio
+import copy
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+from .models import Tutor
+
+TUTOR_CACHE_SIZE = 256
+TUTOR_VERSION_CACHE_KEY = 'tutor_version_{}'
+
+# recently used tutors as {tutor id: (version, tutor)}, most recent last
+recent_tutors = OrderedDict()
+recent_tutors_lock = threading.Lock()
+
+
+def get_tutor(tutor_id):
+    """ returns the tutor with the given id, or None, from this process's cache of recently
+        used tutors if it's still current. Other processes learn of changes through a version
+        in the shared cache, bumped by tutor_changed() """
+    # a version dropped from the cache is replaced by a new one rather than treated as current,
+    # as a tutor cached before it was dropped may have changed since
+    version = cache.get_or_set(TUTOR_VERSION_CACHE_KEY.format(tutor_id),
+                               lambda: int(time.time() * 1000), None)
+    with recent_tutors_lock:
+        cached = recent_tutors.get(tutor_id)
+        if cached and cached[0] == version:
+            recent_tutors.move_to_end(tutor_id)
+            return copy.copy(cached[1])
+
+    tutor = Tutor.objects.filter(id=tutor_id).first()
+    if tutor:
+        with recent_tutors_lock:
+            recent_tutors[tutor_id] = (version, tutor)
+            recent_tutors.move_to_end(tutor_id)
+            while len(recent_tutors) > TUTOR_CACHE_SIZE:
+                recent_tutors.popitem(last=False)
+        tutor = copy.copy(tutor)  # so changes to it aren't seen by other requests
+    return tutor
+
+
+def tutor_changed(tutor_id):
+    """ must be called whenever a tutor is saved, so all processes reload it """
+    with recent_tutors_lock:
+        recent_tutors.pop(tutor_id, None)
+    cache.set(TUTOR_VERSION_CACHE_KEY.format(tutor_id), int(time.time() * 1000), None)
+
+
+def create_api_token(tutor):
+    """ gives the tutor a new token for the JSON API, replacing any they had. Only a hash of
+        it is kept, so it can't be shown again """
+    secret = secrets.token_urlsafe(32)
+    tutor.api_token_hash = hash_api_secret(secret)
+    tutor.save(update_fields=['api_token_hash'])
+    tutor_changed(tutor.id)
+    return '{}.{}'.format(tutor.id, secret)
+
+
+def revoke_api_token(tutor):
+    tutor.api_token_hash = ''
+    tutor.save(update_fields=['api_token_hash'])
+    tutor_changed(tutor.id)
+
+
+def get_tutor_for_api_token(token):
+    """ returns the tutor whose API token this is, or None. The token starts with the tutor's
+        id, so the tutor is usually found in the cache without a query """
+    tutor_id, _, secret = token.partition('.')
+    if not tutor_id.isdigit() or not secret:
+        return None
+    tutor = get_tutor(int(tutor_id))
+    if tutor and tutor.api_token_hash and \
+       hmac.compare_digest(tutor.api_token_hash, hash_api_secret(secret)):
+        return tutor
+    return None
+
+
+def hash_api_secret(secret):
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+
+class CurrentTutorMiddleware:
+    """ sets request.tutor to the logged in tutor, or a false value if there is none. The tutor
+        is only looked up when first used, so pages for students don't pay for it """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # marks the instance as a coroutine function, as django's own middleware does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        # returns the coroutine of async views untouched for django to await
+        request.tutor = SimpleLazyObject(lambda: get_current_tutor(request))
+        return self.get_response(request)
+
+
+def get_current_tutor(request):
+    tutor_id = request.session.get('tutor_id')
+    return get_tutor(tutor_id) if tutor_id else None
@@ -1,4 +1,4 @@
-from django.urls import path
+from django.urls import path, re_path
 from . import views
 
 app_name = 'exeatsapp'
@@ -14,6 +14,15 @@ urlpatterns = [
     path('tutor/view/', views.view, name='view'),
     path('tutor/settings/', views.tutor_settings, name='settings'),
     path('tutor/history/', views.history, name='history'),
+    re_path(r'^tutor/history/export\.(?P<format>csv|json)$', views.history_export,
+            name='history_export'),
     path('signup/<str:hash>', views.signup, name='signup'),
+    path('signup/<str:hash>/availability', views.availability, name='availability'),
+    path('signup/<str:hash>/calendar.ics', views.student_calendar, name='student_calendar'),
+    path('calendar/<str:hash>.ics', views.tutor_calendar, name='tutor_calendar'),
+    path('api/slots', views.api_slots, name='api_slots'),
+    path('api/students', views.api_students, name='api_students'),
+    path('api/attendance', views.api_attendance, name='api_attendance'),
     path('deploy', views.deploy, name='deploy'),
+    path('metrics', views.metrics_endpoint, name='metrics'),
 ]
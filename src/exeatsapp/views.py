@@ -1,26 +1,52 @@
+import csv
 import datetime
 import hashlib
 import hmac
-import subprocess
-import re
 import http
 import json
-import smtplib
-from email.mime.text import MIMEText
-from statistics import mode, median, StatisticsError
+import uuid
+from itertools import chain
 
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
-from django.template.loader import render_to_string
 from django.contrib import messages
-from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect, Http404
+from django.http import (HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+                         HttpResponseRedirect, Http404, JsonResponse,
+                         StreamingHttpResponse)
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.conf import settings
-from django.core.mail import EmailMessage
-from django.utils import timezone
-from django.db.models import Max, Q
-
-from .models import Tutor, Slot, Student
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Q
+from django.utils import formats, timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .models import Tutor, Slot, Student, OutboundEmail, Preference
+from . import metrics
+from .allocation import (MAX_PREFERENCES, is_allocating, get_preferences, save_preferences,
+                         set_allocation_closes)
+from .bulk import MAX_ITEMS, apply_slot_changes, apply_student_changes, mark_attendance
+from .deploys import queue_deploy
+from .feeds import get_feed, get_feed_etag, render_calendar
+from .links import (get_student_for_hash, get_tutor_id_for_hash, get_url_for_student,
+                    get_ids_for_hash, get_calendar_url_for_tutor, get_tutor_id_for_feed_hash)
+from .mail import (email_policy_check, get_from_email, get_recent_mailings,
+                   queue_booking_confirmation)
+from .slots import (generate_slot_times, create_slots, book_slot, get_suggestions,
+                    get_slots_version, get_availability_changes, slots_changed,
+                    bookings_changed, SlotPage)
+from .students import (import_students, parse_student_details, refresh_summaries,
+                       get_segment_filter, get_segments)
+from .tutors import tutor_changed, create_api_token, revoke_api_token, get_tutor_for_api_token
+
+# calendar apps may show a feed this many seconds old before checking it again
+CALENDAR_MAX_AGE = 15 * 60
+
+# the slot and student columns used by the slot listing templates, fetched in one joined query
+SLOT_LISTING_FIELDS = ('start', 'location', 'attended',
+                       'allocatedto__name', 'allocatedto__email', 'allocatedto__alert')
 
 
 def home(request):
@@ -52,40 +78,59 @@ def logout(request):
 
 def login_required(view):
     def wrap(request, *args, **kwargs):
-        if request.session.get('tutor_id', False):
+        if request.tutor:
             return view(request, *args, **kwargs)
         return HttpResponseRedirect(reverse('exeatsapp:login'))
     return wrap
 
 
+def api_token_required(view):
+    """ authenticates a tutor by the API token in the Authorization header instead of their
+        session, so the view needs no CSRF token """
+    @csrf_exempt
+    def wrap(request, *args, **kwargs):
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        tutor = None
+        if authorization.startswith('Bearer '):
+            tutor = get_tutor_for_api_token(authorization[7:])
+        if not tutor:
+            return JsonResponse({'error': 'A valid API token is required'}, status=401)
+        request.tutor = tutor
+        return view(request, *args, **kwargs)
+    return wrap
+
+
 @login_required
 def times(request):
     tutor_id = request.session.get('tutor_id')
     if request.method == 'POST':
         if request.POST.get('startingAt', False):
             start = datetime.datetime.strptime(request.POST['startingAt'], "%d/%m/%y %H:%M")
-            start = timezone.make_aware(start)
             if request.POST.get('endingAt', False):
                 end = datetime.datetime.strptime(request.POST['endingAt'], "%d/%m/%y %H:%M")
-                end = timezone.make_aware(end)
             else:
                 end = start
             duration = int(request.POST.get('duration', 10))
             duration = duration if duration >= 1 else 10
-            tutor = Tutor.objects.get(id=tutor_id)
-
-            first = True
-            slot_count = 0
-            while first or start < end:
-                first = False
-                slot = Slot.objects.create(start=start,
-                                           location=request.POST['location'],
-                                           tutor=tutor)
-                slot.save()
-                slot_count += 1
-                start += datetime.timedelta(minutes=int(duration))
-
-            message = '{} time slot{} added'.format(slot_count, '' if slot_count == 1 else 's')
+
+            try:
+                if request.POST.get('repeatUntil', False):
+                    until = datetime.datetime.strptime(request.POST['repeatUntil'],
+                                                       "%d/%m/%y").date()
+                else:
+                    until = None
+                weekdays = [int(day) for day in request.POST.getlist('repeatOn')]
+                slot_times = generate_slot_times(start, end, duration, until, weekdays)
+                slot_count, skipped_count = create_slots(tutor_id, slot_times,
+                                                         request.POST['location'],
+                                                         duration)
+                skipped_details = ', {} skipped as they overlap existing times'.format(
+                                  skipped_count) if skipped_count else ''
+                message = '{} time slot{} added{}'.format(slot_count,
+                                                          '' if slot_count == 1 else 's',
+                                                          skipped_details)
+            except ValueError as e:
+                message = str(e)
             messages.add_message(request, messages.INFO, message)
 
         if request.POST.get('submitted', False) == 'currentTimes':
@@ -93,35 +138,28 @@ def times(request):
             slots = Slot.objects.filter(id__in=slot_ids, tutor=tutor_id)
             message = '{} time slot{} deleted'.format(len(slots), '' if len(slots) == 1 else 's')
             messages.add_message(request, messages.INFO, message)
+            student_ids = [slot.allocatedto_id for slot in slots if slot.allocatedto_id]
             slots.delete()
+            refresh_summaries(student_ids)
+            slots_changed(tutor_id)
 
         return HttpResponseRedirect(reverse('exeatsapp:times'))
 
     midnight_today = datetime.datetime.combine(datetime.date.today(), datetime.datetime.min.time())
     suggested_start = midnight_today + datetime.timedelta(hours=33)  # 9am tomorrow morning
 
-    latest_slot = Slot.objects.filter(tutor=tutor_id).order_by('-start').first()
-    suggested_location = latest_slot.location if latest_slot else ''
-
-    if latest_slot:  # meaning if they have at least one slot
-        last_50_slot_times = Slot.objects.filter(tutor=tutor_id) \
-                                 .order_by('-start') \
-                                 .values_list('start', flat=True)[0:50]
-        minute_diffs = [(last_50_slot_times[i] - last_50_slot_times[i + 1]).total_seconds() / 60
-                        for i in range(len(last_50_slot_times) - 1)]
-        try:
-            suggested_duration = int(mode(minute_diffs))
-        except StatisticsError:  # if there's no unique most popular duration, use the middle one
-            suggested_duration = int(median(minute_diffs))
-    else:
-        suggested_duration = 10
+    suggested_location, suggested_duration = get_suggestions(tutor_id)
 
     context = {
         'suggested_start': suggested_start,
         'suggested_end': suggested_start + datetime.timedelta(hours=1),
         'suggested_location': suggested_location,
         'suggested_duration': suggested_duration,
-        'slots': Slot.objects.filter(tutor=tutor_id, start__gte=get_midnight()).order_by('start')
+        'weekdays': ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'],
+        'slots': Slot.objects.filter(tutor=tutor_id, start__gte=get_midnight())
+                             .select_related('allocatedto')
+                             .only(*SLOT_LISTING_FIELDS)
+                             .order_by('start')
     }
 
     return render(request, 'exeatsapp/times.html', context)
@@ -143,32 +181,34 @@ def update_students(request):
     tutor_id = request.session.get('tutor_id')
 
     # handle addition of new students
-    csv_string = request.POST.get('csvText', False)
-    student_count = 0
-    skipped_count = 0
-    if csv_string:
-        tutor = Tutor.objects.get(id=tutor_id)
-        for (name, email) in parse_student_details(csv_string):
-            email = email if '@' in email else '{}@cam.ac.uk'.format(email)
-            if not Student.objects.filter(email=email):
-                student = Student.objects.create(name=name, email=email, tutor=tutor)
-                student_count += 1
-                student.save()
-            else:
-                skipped_count += 1
-
-        skipped_details = ', {} skipped as they have already been added'.format(skipped_count) \
-                          if skipped_count else ''
-        message = '{} student{} added{}'.format(student_count,
-                                                '' if student_count == 1 else 's',
-                                                skipped_details)
+    csv_source = request.FILES.get('csvFile') or request.POST.get('csvText', False)
+    if csv_source:
+        unreadable_lines = []
+        report = import_students(tutor_id, parse_student_details(csv_source, unreadable_lines))
+        student_count = len(report.added)
+        skipped_details = ', {} skipped as they have already been added'.format(
+                          len(report.skipped)) if report.skipped else ''
+        invalid_details = ', {} ignored as they could not be read ({})'.format(
+                          len(report.invalid),
+                          ', '.join(email or name for name, email in report.invalid[:5])) \
+                          if report.invalid else ''
+        unreadable_details = ', line{} {} could not be read'.format(
+                             '' if len(unreadable_lines) == 1 else 's',
+                             ', '.join(str(line) for line in unreadable_lines[:10])) \
+                             if unreadable_lines else ''
+        message = '{} student{} added{}{}{}'.format(student_count,
+                                                    '' if student_count == 1 else 's',
+                                                    skipped_details,
+                                                    invalid_details,
+                                                    unreadable_details)
         messages.add_message(request, messages.INFO, message)
 
     # handle removal of existing students
     if request.POST.get('submitted', False) == 'students':
         student_ids = [k[8:] for k, v in request.POST.items() if k[0:8] == 'student_']
         students = Student.objects.filter(id__in=student_ids, tutor=tutor_id)
-        students.delete()
+        students.delete()  # which also frees any slots they had booked
+        bookings_changed(tutor_id)
         message = '{} student{} deleted'.format(len(student_ids),
                                                 '' if len(student_ids) == 1 else 's')
         messages.add_message(request, messages.INFO, message)
@@ -176,169 +216,67 @@ def update_students(request):
     return HttpResponseRedirect(reverse('exeatsapp:students'))
 
 
-def parse_student_details(raw_string):
-    """ returns an array of (name, email) tuples from an input with format one of:
-        1) 'Alice Smith<alice@smith.com>, Bob Smith<bob@smith.com>'
-               (all one line, as produced by the student email list builder)
-        2) 'Alice Smith, alice@smith.com
-            Bob Smith, bob@smith.com'
-        3) 'Smith, Alice, alice@smith.com
-            Smith, Bob, bob@smith.com'
-    """
-    # Try to detect camsis export format
-
-
-    # Try to detect 'Alice Smith<alice@smith.com>, Bob Smith<bob@smith.com>' format
-    details = re.findall(r'\s*(?P<name>[^,\<\>]+?)\s*\<(?P<email>.+?@.+?)\>\s*', raw_string)
-    if details:
-        return details
-
-    # Try to detect comma or tab separated formats
-    # 'Alice Smith, alice@smith.com \n Bob Smith, bob@smith.com'
-    details = []
-    column_lookup = None
-    for line in str.strip(raw_string).split('\n'):
-        separator = '\t' if line[0:3] == '360' else ','
-        parts = list(map(str.strip, line.split(separator)))
-
-        if 'First Name - Pref/Prim' in parts:
-            column_lookup = (
-                parts.index('Last Name'),
-                parts.index('First Name - Pref/Prim'),
-                parts.index('CRSID')
-            )
-            continue
-
-        if column_lookup:
-            reordered_parts = (parts[i] for i in column_lookup)
-            parts = list(reordered_parts)
-
-        if len(parts) == 3:
-            name = '{} {}'.format(parts[1], parts[0])
-            email = parts[2]
-        else:
-            name = parts[0]
-            email = parts[1]
-        details.append((name, email))
-    return details
-
-
-def get_student_for_hash(hash):
-    student_id, _ = hash.split('-')
-    student = Student.objects.get(id=student_id)
-    return student if hash == get_hash_for_student(student) else None
-
-
-def get_hash_for_student(student):
-    salt = 'zov5!5!2onxl'  # todo - move this into config and change value (at time when it won't matter that all old links failed)
-    cleartext = salt + student.email
-    return str(student.id) + '-' + hashlib.md5(cleartext.encode('utf-8')).hexdigest()[0:12]
-
-
-def get_url_for_student(student):
-    hash = get_hash_for_student(student)
-    return settings.BASE_URL + reverse('exeatsapp:signup', kwargs={'hash': hash})
-
-
-def is_mailgun():
-    """ returns true if we are using mailgun as our smtp host """
-    return 'mailgun' in settings.EMAIL_HOST
-
-
 @login_required
 def emails(request):
     tutor_id = request.session.get('tutor_id')
-    tutor = Tutor.objects.get(id=tutor_id)
+    tutor = request.tutor
     if request.method == 'POST':
         body_template = request.POST.get('emailBody', False)
-        student_ids   = [k[8:] for k, v in request.POST.items() if k[0:8] == 'student_']
-        students      = Student.objects.filter(id__in=student_ids, tutor=tutor_id)
-
-        subject    = request.POST['subject']
-        from_email = '{}<{}>'.format(settings.SYSTEM_FROM_NAME, settings.SYSTEM_FROM_EMAIL)
-        headers    = {'Reply-To': tutor.email}
-        recipient_vars = {}
-        try:
-            for student in students:
-                to_email = email_policy_check(student.email)
-                link     = get_url_for_student(student)
-                if is_mailgun():  # for mailgun we build a list for a single-request multi-send
-                    recipient_vars[to_email] = {'link': link}
-                else:  # for regular smtp we make a request per student
-                    body  = body_template.replace('[link]', link)
-                    email = EmailMessage(subject, body, from_email, [to_email], headers=headers)
-                    email.send()
-
-            if is_mailgun():
-                # to use mailgun's batch sending feature we need to pass a separate To: header on
-                # the message from that we give in the RCPT handshake, so we need to use a lower-
-                # level smtplib class.
-                # https://documentation.mailgun.com/en/latest/user_manual.html#batch-sending
-                body           = body_template.replace('[link]', '%recipient.link%')
-                msg            = MIMEText(body)
-                msg['Subject'] = subject
-                msg['From']    = from_email
-                msg['To']      = "%recipient%"
-                rcpt_to        = list(recipient_vars.keys())
-                # todo - Docs suggest 998 char limit but testing shows effective with 1394
-                #        I suspect email.policy.SMTP.fold is already being called here
-                msg['X-Mailgun-Recipient-Variables'] = json.dumps(recipient_vars)
-                smtp = smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT)
-                smtp.login(settings.EMAIL_HOST_USER, settings.EMAIL_HOST_PASSWORD)
-                smtp.sendmail(settings.SYSTEM_FROM_EMAIL, rcpt_to, msg.as_string())
-                smtp.quit()
-
-            message_text = '{} email{} sent'.format(len(students),
-                                                    '' if len(students) == 1 else 's')
-        except (smtplib.SMTPDataError, smtplib.SMTPAuthenticationError) as e:
-            message_text = 'Email sending failed. ' + \
-                           'This normally means we have hit a daily or hourly sending limit.'
-
+        # recipients are the chosen segment, less any excluded, plus any individually chosen
+        selected = Q(id__in=request.POST.getlist('student'))
+        segment  = request.POST.get('segment')
+        if segment:
+            try:
+                selected |= get_segment_filter(segment, timezone.now()) & \
+                    ~Q(id__in=request.POST.getlist('exclude'))
+            except KeyError:
+                return HttpResponseBadRequest('unknown segment')
+        students = list(Student.objects.filter(selected, tutor=tutor_id))
+
+        batch = uuid.uuid4().hex
+        OutboundEmail.objects.bulk_create([
+            OutboundEmail(tutor=tutor, batch=batch,
+                          to_email=email_policy_check(student.email),
+                          from_email=get_from_email(),
+                          reply_to=tutor.email,
+                          subject=request.POST['subject'],
+                          body=body_template,
+                          link=get_url_for_student(student))
+            for student in students
+        ])
+        message_text = '{} email{} queued for sending'.format(len(students),
+                                                              '' if len(students) == 1 else 's')
         messages.add_message(request, messages.INFO, message_text)
         return HttpResponseRedirect(reverse('exeatsapp:emails'))
 
+    students = list(Student.objects.filter(tutor=tutor_id).order_by('name'))
+    now = timezone.now()
+    for student in students:
+        student.segments = ' '.join(get_segments(student, now))
     context = {
-        'students': Student.objects.filter(tutor=request.session['tutor_id'])
-                                   .annotate(last_slot=Max('slot__start'))
-                                   .annotate(last_attended=Max('slot__start',
-                                                               filter=Q(slot__attended=True)))
-                                   .order_by('name'),
+        'students': students,
         'tutor': tutor,
+        'mailings': get_recent_mailings(tutor_id),
     }
     return render(request, 'exeatsapp/emails.html', context)
 
 
-def signup(request, hash):
-    student = get_student_for_hash(hash)
+async def signup(request, hash):
+    """ async, so that a burst of bookings after a mailing waits on the database without each
+        holding a worker when served over ASGI. The database work runs in threads """
+    student = await sync_to_async(get_student_for_hash)(hash)
     if not student:
         raise Http404('link appears to be invalid')
 
+    if request.method == 'POST' and student.tutor.allocation_closes:
+        return await sync_to_async(submit_preferences)(request, student)
+
     if request.method == 'POST':
         slot_id = [k[5:] for k, v in request.POST.items() if k[0:5] == 'slot_'][0]
-        slot = Slot.objects.filter(id=slot_id, tutor=student.tutor.id, allocatedto=None).first()
+        slot = await sync_to_async(book_slot)(slot_id, student)
         if slot:
-            # un-book any booked future slots
-            existing_bookings = Slot.objects.filter(allocatedto=student.id,
-                                                    start__gte=datetime.datetime.now())
-            for booking in existing_bookings:
-                booking.allocatedto = None
-                booking.save()
-            # book chosen slot
-            slot.allocatedto = student
-            slot.save()
-            subject  = 'Booking confirmation'
-            context  = {'slot': slot, 'url': get_url_for_student(student)}
-            body     = render_to_string('exeatsapp/emailconfirmation.html', context)
-            to_email = email_policy_check(student.email)
-            email = EmailMessage(subject, body,
-                                 '{}<{}>'.format(settings.SYSTEM_FROM_NAME,
-                                                 settings.SYSTEM_FROM_EMAIL),
-                                 [to_email])
-            try:
-                email.send()
-                message_text = 'Slot booked. We have sent you a confirmation by email.'
-            except (smtplib.SMTPDataError, smtplib.SMTPAuthenticationError) as e:
-                message_text = 'Slot booked. We were unable to send an email confirmation.'
+            await sync_to_async(queue_booking_confirmation)(student, slot)
+            message_text = 'Slot booked. We will send you a confirmation by email shortly.'
 
         else:
             message_text = 'Booking slot not available, please choose a different slot.'
@@ -346,24 +284,134 @@ def signup(request, hash):
         messages.add_message(request, messages.INFO, message_text)
         return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
+    return await sync_to_async(render_signup)(request, student, hash)
+
+
+def render_signup(request, student, hash):
     context = {
         'student': student,
+        'slots_version': get_slots_version(student.tutor_id),
+        'availability_url': reverse('exeatsapp:availability', kwargs={'hash': hash}),
+        'calendar_url': reverse('exeatsapp:student_calendar', kwargs={'hash': hash}),
         'chosen_slot': Slot.objects.filter(allocatedto=student.id,
                                            start__gte=datetime.datetime.now()
                                            ).first(),
-        'slots': Slot.objects.filter(tutor=student.tutor.id,
+        'slots': Slot.objects.filter(tutor=student.tutor_id,
                                      start__gte=datetime.datetime.now()
-                                     ).order_by('start')
+                                     ).select_related('allocatedto')
+                                      .only(*SLOT_LISTING_FIELDS)
+                                      .order_by('start')
     }
+    if student.tutor.allocation_closes:
+        context['allocation_closes'] = student.tutor.allocation_closes
+        context['allocating'] = is_allocating(student.tutor)
+        context['ranks'] = range(1, MAX_PREFERENCES + 1)
+        preferences = get_preferences(student)
+        context['slots'] = list(context['slots'].filter(allocatedto=None))
+        for slot in context['slots']:
+            slot.rank = preferences.get(slot.id)
     return render(request, 'exeatsapp/signup.html', context)
 
 
+def submit_preferences(request, student):
+    """ saves the slots a student has ranked while their tutor is allocating by preference """
+    try:
+        ranked = sorted((int(v), int(k[5:])) for k, v in request.POST.items()
+                        if k[0:5] == 'rank_' and v)
+    except ValueError:
+        ranked = None
+    ranks = [rank for rank, _ in ranked or []]
+    if not is_allocating(student.tutor):
+        message_text = 'Choices have closed, slots are being allocated.'
+    elif ranked is None or not all(1 <= rank <= MAX_PREFERENCES and 0 < slot_id < 2 ** 31
+                                   for rank, slot_id in ranked):
+        message_text = 'Please number your choices from 1 to {}.'.format(MAX_PREFERENCES)
+    elif len(set(ranks)) < len(ranks):
+        message_text = 'Please give each of your choices a different number.'
+    else:
+        save_preferences(student, [slot_id for _, slot_id in ranked])
+        message_text = 'Your choices have been saved. Slots will be allocated after {}.'.format(
+            formats.date_format(timezone.localtime(student.tutor.allocation_closes),
+                                'SHORT_DATETIME_FORMAT'))
+    messages.add_message(request, messages.INFO, message_text)
+    return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
+
+
+async def availability(request, hash):
+    """ returns which of the tutor's slots have been taken or freed since the `since` version,
+        so that the signup page can keep itself up to date without being reloaded """
+    tutor_id = await sync_to_async(get_tutor_id_for_hash)(hash)
+    if not tutor_id:
+        raise Http404('link appears to be invalid')
+    try:
+        since = int(request.GET.get('since', ''))
+    except ValueError:
+        return HttpResponseBadRequest('since must be a version number')
+
+    version, changes = await sync_to_async(get_availability_changes)(tutor_id, since)
+    if changes is None:
+        return JsonResponse({'version': version, 'reload': True})
+    return JsonResponse({'version': version,
+                         'changes': {slot_id: 'taken' if taken else 'free'
+                                     for slot_id, taken in changes.items()}})
+
+
+def tutor_calendar(request, hash):
+    """ an iCalendar feed of the tutor's upcoming slots, for calendar apps to subscribe to """
+    tutor_id = get_tutor_id_for_feed_hash(hash)
+    if not tutor_id:
+        raise Http404('link appears to be invalid')
+    return calendar_response(request, tutor_id)
+
+
+def student_calendar(request, hash):
+    """ an iCalendar feed of the slot a student has booked, found by their signup link """
+    ids = get_ids_for_hash(hash)
+    if not ids:
+        raise Http404('link appears to be invalid')
+    student_id, tutor_id = ids
+    return calendar_response(request, tutor_id, student_id)
+
+
+def calendar_response(request, tutor_id, student_id=None):
+    """ serves a calendar feed, answering calendar apps checking for changes with a 304 from
+        the slots' version alone, without fetching any slots """
+    version = get_slots_version(tutor_id)
+    etag = get_feed_etag(tutor_id, version, student_id)
+    response = get_conditional_response(request, etag=etag)
+    if response:
+        return response
+
+    tutor_name, events, last_modified = get_feed(tutor_id, version)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response:
+        return response
+    if student_id:
+        name = 'Exeat with {}'.format(tutor_name)
+        events = [dict(event, summary=name) for event in events
+                  if event['student_id'] == student_id]
+    else:
+        name = 'Exeats for {}'.format(tutor_name)
+        events = [dict(event, summary='Exeat: {}'.format(event['student_name'] or 'free'))
+                  for event in events]
+    response = HttpResponse(render_calendar(name, events, last_modified),
+                            content_type='text/calendar; charset=utf-8')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, max-age={}'.format(CALENDAR_MAX_AGE)
+    return response
+
+
 @login_required
 def view(request):
     context = {
+        'tutor_id': request.session['tutor_id'],
+        'slots_version': get_slots_version(request.session['tutor_id']),
         'slots': Slot.objects.filter(tutor=request.session['tutor_id'],
                                      start__gte=get_midnight()
-                                     ).order_by('start')
+                                     ).select_related('allocatedto')
+                                      .only(*SLOT_LISTING_FIELDS)
+                                      .order_by('start')
     }
     return render(request, 'exeatsapp/view.html', context)
 
@@ -377,6 +425,8 @@ def toggle_attended(request, id):
 
     slot.attended = not slot.attended
     slot.save()
+    refresh_summaries([slot.allocatedto_id])
+    bookings_changed(slot.tutor_id, {})
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
 
@@ -389,55 +439,198 @@ def toggle_alert(request, id):
 
     student.alert = not student.alert
     student.save()
+    bookings_changed(student.tutor_id, {})
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
 
 @login_required
 def history(request):
+    before = request.GET.get('before', '')
     context = {
-        'slots': Slot.objects.filter(tutor=request.session['tutor_id'],
-                                     start__lte=datetime.datetime.now(),
-                                     allocatedto__isnull=False
-                                     ).order_by('-start')
+        'tutor_id': request.session['tutor_id'],
+        'slots_version': get_slots_version(request.session['tutor_id']),
+        'before': before,
+        'page': SlotPage(get_history_slots(request.session['tutor_id'])
+                         .select_related('allocatedto')
+                         .only(*SLOT_LISTING_FIELDS),
+                         before),
     }
     return render(request, 'exeatsapp/history.html', context)
 
 
+@login_required
+def history_export(request, format):
+    """ streams the tutor's whole history as csv or json, a chunk of rows at a time, or under
+        ASGI returns it in one piece """
+    rows = get_history_slots(request.session['tutor_id']) \
+        .order_by('-start', '-id') \
+        .values_list('start', 'location', 'allocatedto__name', 'allocatedto__email', 'attended') \
+        .iterator(chunk_size=2000)
+    rows = ((timezone.localtime(start).isoformat(), location, name, email, attended)
+            for start, location, name, email, attended in rows)
+
+    if format == 'json':
+        content, content_type = stream_json(rows), 'application/json'
+    else:
+        writer = csv.writer(Echo())
+        header = ('start', 'location', 'student', 'email', 'attended')
+        content = (writer.writerow(row) for row in chain([header], rows))
+        content_type = 'text/csv'
+    if isinstance(request, ASGIRequest):
+        # django's ASGI handler iterates a streaming response in the event loop, where the
+        # queries can't be run, so the export is built here in the view's thread instead
+        response = HttpResponse(''.join(content), content_type=content_type)
+    else:
+        response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="history.{}"'.format(format)
+    return response
+
+
+def get_history_slots(tutor_id):
+    return Slot.objects.filter(tutor=tutor_id,
+                               start__lte=timezone.now(),
+                               allocatedto__isnull=False)
+
+
+class Echo:
+    """ a file-like object which returns what is written to it, so csv.writer can be streamed """
+    def write(self, value):
+        return value
+
+
+def stream_json(rows):
+    fields = ('start', 'location', 'student', 'email', 'attended')
+    yield '['
+    for i, row in enumerate(rows):
+        yield (',' if i else '') + json.dumps(dict(zip(fields, row)))
+    yield ']'
+
+
 @login_required
 def tutor_settings(request):
-    tutor = Tutor.objects.get(id=request.session['tutor_id'])
+    tutor = request.tutor
+    if request.method == 'POST' and 'api_token' in request.POST:
+        if request.POST['api_token'] == 'revoke':
+            revoke_api_token(tutor)
+            message_text = 'API token revoked'
+        else:
+            message_text = 'Your new API token is {} - it will not be shown again'.format(
+                create_api_token(tutor))
+        messages.add_message(request, messages.INFO, message_text)
+        return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
+
+    if request.method == 'POST' and 'allocation_closes' in request.POST:
+        closes = None
+        if request.POST['allocation_closes']:
+            closes = timezone.make_aware(
+                datetime.datetime.strptime(request.POST['allocation_closes'], "%d/%m/%y %H:%M"))
+        set_allocation_closes(tutor, closes)
+        if closes:
+            message_text = 'Students will rank slots until {}'.format(
+                formats.date_format(closes, 'SHORT_DATETIME_FORMAT'))
+        else:
+            message_text = 'Students will book slots first come first served'
+        messages.add_message(request, messages.INFO, message_text)
+        return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
+
     if request.method == 'POST':
         tutor.name = request.POST['tutor_name']
-        tutor.save()
+        tutor.save(update_fields=['name'])
+        tutor_changed(tutor.id)
+        bookings_changed(tutor.id, {})  # so the calendar feeds, which show the name, are rebuilt
         message_text = 'Tutor name changed'
         messages.add_message(request, messages.INFO, message_text)
         return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
     context = {
-        'tutor': tutor
+        'tutor': tutor,
+        'calendar_url': get_calendar_url_for_tutor(tutor.id),
+        'preference_count': Preference.objects.filter(student__tutor=tutor)
+                                              .values('student').distinct().count(),
     }
     return render(request, 'exeatsapp/settings.html', context)
 
 
 @csrf_exempt
 def deploy(request):
-    """ triggers git pull of updated application code on receipt of valid webhook """
+    """ queues an update of the application code on receipt of a valid webhook. The update is
+        carried out by the run_deploys worker, so that no web worker waits on it """
     github_signature = request.META['HTTP_X_HUB_SIGNATURE']
     signature = hmac.new(settings.SECRET_DEPLOY_KEY.encode('utf-8'), request.body, hashlib.sha1)
     expected_signature = 'sha1=' + signature.hexdigest()
     if not hmac.compare_digest(github_signature, expected_signature):
         return HttpResponseForbidden('Invalid signature header')
 
-    if subprocess.run(["git", "pull"], timeout=15).returncode == 0 and \
-       subprocess.run(["python", "manage.py", "migrate"], timeout=15).returncode == 0 and \
-       subprocess.run(["python", "manage.py", "collectstatic", "--noinput"], timeout=15).returncode == 0:
-        return HttpResponse('Webhook received', status=http.client.ACCEPTED)
-    raise Http404("Update failed")
-
-
-def email_policy_check(email):
-    """ overwrites email addresses with a saftey address if set """
-    return getattr(settings, 'ALL_EMAILS_TO', email)
+    try:
+        commit = json.loads(request.body).get('after', '')
+    except ValueError:
+        commit = ''
+    deploy = queue_deploy(commit)
+    return HttpResponse('Deploy {} queued'.format(deploy.id), status=http.client.ACCEPTED)
+
+
+@require_POST
+@api_token_required
+def api_slots(request):
+    """ creates, updates and deletes many of the tutor's slots at once, eg.
+        {"create": [{"start": "2018-06-06T09:30", "location": "A1"}],
+         "update": [{"id": 1, "attended": true}], "delete": [2, 3]} """
+    changes, response = read_api_changes(request, ('create', 'update', 'delete'))
+    if response:
+        return response
+    return JsonResponse(apply_slot_changes(request.tutor.id, **changes))
+
+
+@require_POST
+@api_token_required
+def api_students(request):
+    """ creates, updates and deletes many of the tutor's students at once, eg.
+        {"create": [{"name": "A Student", "email": "as123"}],
+         "update": [{"id": 1, "alert": true}], "delete": [2, 3]} """
+    changes, response = read_api_changes(request, ('create', 'update', 'delete'))
+    if response:
+        return response
+    return JsonResponse(apply_student_changes(request.tutor.id, **changes))
+
+
+@require_POST
+@api_token_required
+def api_attendance(request):
+    """ marks many of the tutor's slots as attended or not at once, eg.
+        {"slots": [{"id": 1, "attended": true}, {"id": 2, "attended": false}]} """
+    changes, response = read_api_changes(request, ('slots',))
+    if response:
+        return response
+    return JsonResponse({'slots': mark_attendance(request.tutor.id, changes.get('slots', []))})
+
+
+def read_api_changes(request, names):
+    """ returns ({name: list of changes}, None) from a JSON request body, or (None, response)
+        if it can't be used """
+    try:
+        body = json.loads(request.body)
+    except ValueError:
+        return None, JsonResponse({'error': 'The body must be JSON'}, status=400)
+    if not isinstance(body, dict) or \
+       not all(isinstance(body.get(name, []), list) for name in names):
+        return None, JsonResponse({'error': 'Expected an object with lists of {}'.format(
+                                  ', '.join(names))}, status=400)
+    changes = {name: body[name] for name in names if name in body}
+    if sum(len(items) for items in changes.values()) > MAX_ITEMS:
+        return None, JsonResponse({'error': 'At most {} changes can be made at once'.format(
+                                  MAX_ITEMS)}, status=400)
+    return changes, None
+
+
+def metrics_endpoint(request):
+    """ serves request metrics in the prometheus text format to holders of METRICS_TOKEN """
+    if not settings.METRICS_TOKEN:
+        raise Http404('metrics are not enabled')
+    expected = 'Bearer ' + settings.METRICS_TOKEN
+    if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), expected):
+        return HttpResponseForbidden('Invalid authorization header')
+    return HttpResponse(metrics.render_prometheus(*metrics.collect()),
+                        content_type='text/plain; version=0.0.4')
 
 
 def get_midnight():
@@ -0,0 +1,30 @@
+import os
+
+from django.template import engines
+from django.template.utils import get_app_template_dirs
+from django.urls import get_resolver
+
+
+def warm_up():
+    """ does the work otherwise left to the first requests a new worker serves: importing the
+        views, building the url resolver's lookups and compiling every template into the
+        cached template loader. Returns the number of templates compiled """
+    resolver = get_resolver()
+    resolver.reverse_dict  # imports every view module and populates the resolver
+
+    count = 0
+    for engine in engines.all():
+        for name in get_template_names(engine):
+            engine.get_template(name)
+            count += 1
+    return count
+
+
+def get_template_names(engine):
+    template_dirs = list(engine.dirs)
+    if engine.app_dirs:
+        template_dirs += get_app_template_dirs(engine.app_dirname)
+    for template_dir in template_dirs:
+        for root, _, files in os.walk(template_dir):
+            for filename in files:
+                yield os.path.relpath(os.path.join(root, filename), template_dir)
@@ -0,0 +1,20 @@
+"""
+ASGI config for exeatsproject project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "exeatsproject.settings")
+
+application = get_asgi_application()
+
+# a new worker loads everything before it accepts requests, rather than during its first ones
+from exeatsapp.warmup import warm_up  # noqa: E402
+warm_up()
@@ -24,6 +24,14 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SECRET_KEY = getattr(credentials, 'SECRET_KEY', 'xa4a3Pq#tKu*yAgH8X1xn&FT3NepT7Y9$tp%')
 SECRET_DEPLOY_KEY = getattr(credentials, 'SECRET_DEPLOY_KEY', False)
 
+# Keys used to sign students' signup links, newest first. Links signed with an older key keep
+# working until it is removed from the list, and links from before signing was introduced
+# are accepted while SIGNUP_LINK_ACCEPT_LEGACY is set
+SIGNUP_LINK_KEYS = getattr(credentials, 'SIGNUP_LINK_KEYS', [SECRET_KEY])
+SIGNUP_LINK_ACCEPT_LEGACY = getattr(credentials, 'SIGNUP_LINK_ACCEPT_LEGACY', True)
+# If set, signup links stop working this many days after they are sent
+SIGNUP_LINK_MAX_AGE_DAYS = getattr(credentials, 'SIGNUP_LINK_MAX_AGE_DAYS', None)
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = getattr(credentials, 'DEBUG', False)
 
@@ -39,12 +47,15 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'pipeline',
     'exeatsapp',
 ]
 
 MIDDLEWARE = [
+    'exeatsapp.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'exeatsapp.tutors.CurrentTutorMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     # 'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -56,7 +67,8 @@ ROOT_URLCONF = 'exeatsproject.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the django backend, timing template rendering for the metrics middleware
+        'BACKEND': 'exeatsapp.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -71,8 +83,20 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'exeatsproject.wsgi.application'
-
-SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
+ASGI_APPLICATION = 'exeatsproject.asgi.application'
+
+# Request metrics are served at /metrics to requests bearing this token, and not at all if
+# it is unset. Every request is timed, but only this fraction of them has its queries and
+# template rendering profiled. Requests slower than METRICS_SLOW_REQUEST_SECONDS are logged
+METRICS_TOKEN = getattr(credentials, 'METRICS_TOKEN', None)
+METRICS_SAMPLE_RATE = getattr(credentials, 'METRICS_SAMPLE_RATE', 0.1)
+METRICS_SLOW_REQUEST_SECONDS = getattr(credentials, 'METRICS_SLOW_REQUEST_SECONDS', 1.0)
+
+# Signed cookies need no storage, but the signature is checked on every request and the
+# flash messages travel in the cookie too. 'django.contrib.sessions.backends.cached_db' keeps
+# sessions in the cache, backed by the database. Changing this logs everyone out
+SESSION_ENGINE = getattr(credentials, 'SESSION_ENGINE',
+                         'django.contrib.sessions.backends.signed_cookies')
 SESSION_COOKIE_HTTPONLY = True
 
 # Database
@@ -97,6 +121,32 @@ else:
         }
     }
 
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+# If set, persistent connections are checked with a trivial query at most this often, and
+# replaced if they have stopped working. See settings_production.py
+DB_HEALTH_CHECK_SECONDS = None
+
+# If set, the deploy webhook sends gunicorn's master process a HUP to reload the workers
+GUNICORN_PIDFILE = None
+
+
+# Cache shared by all gunicorn workers, so an invalidation in one is seen by the others.
+# Nothing in it needs to be updated atomically, as the file backend can't. Once it holds
+# MAX_ENTRIES a third of them are deleted at random, so it is sized for a slot table fragment
+# per page for every tutor during a booking rush rather than django's default of 300
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': getattr(credentials, 'CACHE_LOCATION', '/var/tmp/exeats_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': getattr(credentials, 'CACHE_MAX_ENTRIES', 10000),
+        },
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -137,6 +187,38 @@ SHORT_DATETIME_FORMAT = "H:i D j M Y"
 STATIC_ROOT = getattr(credentials, 'STATIC_ROOT', os.path.join(BASE_DIR, 'static/'))
 STATIC_URL = '/static/'
 
+STATICFILES_FINDERS = [
+    'django.contrib.staticfiles.finders.FileSystemFinder',
+    'django.contrib.staticfiles.finders.AppDirectoriesFinder',
+    'pipeline.finders.PipelineFinder',
+]
+
+# The stylesheet and script shared by every page, compiled and joined into single files by
+# collectstatic. In production these are also given content hashed names and precompressed,
+# see exeatsapp/storage.py, so nginx can serve them with far future expiry
+STATICFILES_STORAGE = 'pipeline.storage.PipelineStorage'
+PIPELINE = {
+    'STYLESHEETS': {
+        'layout': {
+            'source_filenames': ('exeatsapp/scss/layout.scss',),
+            'output_filename': 'exeatsapp/layout.css',
+        },
+    },
+    'JAVASCRIPT': {
+        'layout': {
+            'source_filenames': ('exeatsapp/js/layout.js',),
+            'output_filename': 'exeatsapp/layout.js',
+        },
+    },
+    'COMPILERS': ('libsasscompiler.LibSassCompiler',),
+    # libsass already minifies the css when DEBUG is off, and the script is small enough
+    # for compressing it on the wire to be all that's worthwhile
+    'CSS_COMPRESSOR': 'pipeline.compressors.NoopCompressor',
+    'JS_COMPRESSOR': 'pipeline.compressors.NoopCompressor',
+    # toggle_flag() is called from the pages, so must stay global
+    'DISABLE_WRAPPER': True,
+}
+
 # todo - consider re-implementing Tutor as base auth model
 # AUTH_USER_MODEL = 'exeatsapp.Tutor'
 
@@ -146,6 +228,10 @@ EMAIL_HOST_PASSWORD = credentials.EMAIL_HOST_PASSWORD
 EMAIL_PORT          = 587
 EMAIL_USE_TLS       = True
 
+# Queued emails are sent by `manage.py send_queued_emails` in no more than this many SMTP
+# transactions a minute, where a whole mailgun batch of recipients counts as one
+EMAIL_MAX_PER_MINUTE = getattr(credentials, 'EMAIL_MAX_PER_MINUTE', 300)
+
 SYSTEM_FROM_EMAIL = 'no-reply@exeats.com'
 SYSTEM_FROM_NAME  = 'Booking System'
 # If set all system emails will be sent here
@@ -0,0 +1,36 @@
+"""
+Settings for the production servers started by gunicorn-start.sh, on top of settings.py.
+
+Database connections are kept open between requests rather than being set up for each one,
+and can be made through a local pooler such as PgBouncer by setting DB_POOL_HOST and
+DB_POOL_PORT in credentials.py (see pgbouncer.ini).
+"""
+
+import os
+
+from .settings import *  # noqa
+from .settings import credentials, DATABASES
+
+DEBUG = False
+
+# seconds to keep each worker's connection open for, checking it still works before reuse
+DATABASES['default']['CONN_MAX_AGE'] = getattr(credentials, 'DB_CONN_MAX_AGE', 600)
+DB_HEALTH_CHECK_SECONDS = getattr(credentials, 'DB_HEALTH_CHECK_SECONDS', 30)
+
+# ASGI runs each request's queries in its own thread, so its connections can't be reused
+# by the next request and would only accumulate. Use the pooler instead
+if os.environ.get('INTERFACE') == 'asgi':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+
+if getattr(credentials, 'DB_POOL_HOST', False):
+    DATABASES['default']['HOST'] = credentials.DB_POOL_HOST
+    DATABASES['default']['PORT'] = getattr(credentials, 'DB_POOL_PORT', 6432)
+    # a pooler in transaction mode may run each query of a server-side cursor on a different
+    # connection, so stream the history export with client-side cursors instead
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+# the deploy webhook gracefully restarts the gunicorn workers after updating the code
+GUNICORN_PIDFILE = '/run/gunicorn.pid'
+
+# collectstatic writes content hashed, precompressed static files, see django-nginx.conf
+STATICFILES_STORAGE = 'exeatsapp.storage.CompressedManifestStorage'
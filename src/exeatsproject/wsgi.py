@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "exeatsproject.settings")
 
 application = get_wsgi_application()
+
+# a new worker loads everything before it accepts requests, rather than during its first ones
+from exeatsapp.warmup import warm_up  # noqa: E402
+warm_up()